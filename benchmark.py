@@ -0,0 +1,263 @@
+# Offline benchmarks of the simulation pipeline, on synthetic seasons (no input_data or network needed)
+#   python benchmark.py stages     times each stage of simulating and processing seasons
+#   python benchmark.py scaling    scaling curves across numbers of seasons and of worker processes
+#   python benchmark.py check      compares the stage timings to a stored baseline, and fails on regressions
+#   python benchmark.py startup    times importing the CLI modules, and fails when they're over budget
+
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import typer
+import numpy as np
+import pandas as pd
+import datasource as ds
+import perf_utils
+import season_simulator as sim
+import series_probs_compute as probs
+import sim_engine
+import sim_inputs
+import sim_output
+import sim_results_processing
+
+app = typer.Typer()
+
+BASELINE_FILENAME = 'benchmark_baseline.json'
+STARTUP_MODULES = ['season_simulator', 'parallel_driver', 'sim_inputs', 'refresh', 'cluster']
+STAGES = ['sim_n_seasons', 'standings', 'add_division_winners', 'add_lg_ranks', 'series_shares', 'summarize_results', 'write_output']
+
+
+# The number of games each pair of teams plays in a balanced (2023-style) 162-game schedule:
+#   13 against each division rival
+#   6 or 7 against the other teams in the league (7 against two teams in each of the other divisions)
+#   3 against each interleague team, except 4 against the natural rival (the same position in the matching division)
+def get_series_lengths(league_structure):
+    ls = league_structure.copy()
+    ls['pos'] = ls.groupby('div').cumcount()
+    ls['div_num'] = ls.groupby('lg')['div'].rank(method='dense').astype(int)
+    lengths = {}
+    teams = list(ls.index)
+    for (i, a) in enumerate(teams):
+        for b in teams[i+1:]:
+            (ta, tb) = (ls.loc[a], ls.loc[b])
+            if ta['div'] == tb['div']:
+                n = 13
+            elif ta['lg'] == tb['lg']:
+                (first, second) = (ta, tb) if ta['div_num'] < tb['div_num'] else (tb, ta)
+                n = 7 if (second['pos'] - first['pos']) % 5 in (0, 1) else 6
+            else:
+                n = 4 if (ta['div_num'], ta['pos']) == (tb['div_num'], tb['pos']) else 3
+            lengths[(a, b)] = n
+    return lengths
+
+
+# A synthetic season: (played, remain, ratings), in the same format as datasource's input tables
+# frac_played of the games (in random calendar order) have been played, with results drawn from the ratings
+def generate_season(frac_played=0.75, seed=0, rating_spread=50, league_structure=None):
+    league_structure = league_structure if league_structure is not None else ds.league_structure
+    rng = np.random.default_rng(seed)
+    rows = []
+    for ((a, b), n) in get_series_lengths(league_structure).items():
+        home_first = rng.random() < 0.5
+        rows += [(a, b) if (k % 2 == 0) == home_first else (b, a) for k in range(n)]
+    games = pd.DataFrame(rows, columns=['team1', 'team2']).sample(frac=1, random_state=rng).reset_index(drop=True)
+    games.index = pd.Index(games.index + 700000, name='gamePk')
+
+    # Spread the games over a 186-day season
+    opening_day = datetime.date(2025, 3, 27)
+    days = games.index.to_numpy() - games.index[0]
+    games['date'] = [str(opening_day + datetime.timedelta(days=int(d))) for d in days * 186 // len(games)]
+
+    ratings = pd.Series(rng.normal(1500, rating_spread, len(league_structure)),
+                        index=pd.Index(league_structure.index, name='team'), name='rating')
+
+    num_played = int(len(games) * frac_played)
+    played = games.iloc[:num_played].drop(columns='date')
+    p_home_win = probs.p_game(ratings[played['team1']].to_numpy(), ratings[played['team2']].to_numpy())
+    home_win = rng.random(num_played) < p_home_win
+    played['score1'] = np.where(home_win, 5, 3)
+    played['score2'] = np.where(home_win, 2, 4)
+    played['margin'] = played['score1'] - played['score2']
+    played['W'] = np.where(home_win, played['team1'], played['team2'])
+    played['L'] = np.where(home_win, played['team2'], played['team1'])
+    return (played, games.iloc[num_played:], ratings)
+
+
+def generate_inputs(frac_played=0.75, seed=0):
+    (played, remain, ratings) = generate_season(frac_played, seed)
+    return sim_inputs.build_inputs(played, remain, ratings, ds.league_structure)
+
+
+# Output goes to a temporary directory, rather than to output/
+@contextlib.contextmanager
+def temporary_output():
+    basedir = sim_output.OUTPUT_BASEDIR
+    with tempfile.TemporaryDirectory() as tmp:
+        sim_output.OUTPUT_BASEDIR = tmp
+        try:
+            yield tmp
+        finally:
+            sim_output.OUTPUT_BASEDIR = basedir
+
+
+# Seconds spent in each stage of simulating and processing num_seasons seasons (as one chunk)
+def time_stages(inputs, num_seasons, seed=0):
+    rng = np.random.default_rng(seed)
+    team_ratings = inputs.ratings.reindex(inputs.schedule.teams).to_numpy()
+    win_prob = inputs.schedule.win_probs(team_ratings)
+    with perf_utils.collect_metrics() as metrics:
+        with perf_utils.stage('sim_n_seasons'):
+            sim_results = sim_engine.simulate(inputs.schedule, win_prob, num_seasons, ratings=team_ratings, rng=rng)
+        standings = sim_results_processing.process_sim_results(sim_results, inputs, rng)
+        with perf_utils.stage('summarize_results'):
+            sim_results_processing.summarize_results(standings)
+        with temporary_output(), perf_utils.stage('write_output'), sim_output.ResultStore() as store:
+            store.write(standings, 'standings', 0)
+    return {name: stats['wall'] for (name, stats) in metrics.stages.items()}
+
+
+# The fastest of repeat timings of each stage, in seconds per 1,000 seasons
+def benchmark_stages(inputs, num_seasons, repeat):
+    timings = pd.DataFrame([time_stages(inputs, num_seasons, seed) for seed in range(repeat)])[STAGES]
+    return timings.min() * 1000 / num_seasons
+
+
+# Like parallel_driver.sim_seasons, the job writes its own output (here, to a temporary directory)
+def __run_worker_job(num_seasons, id):
+    with temporary_output():
+        sim.run_job(sim_inputs.get_inputs(), num_seasons, id, save_summary=False, seed=id)
+    return num_seasons
+
+
+# Seasons per second with num_workers processes, each running jobs_per_worker jobs of num_seasons
+def benchmark_workers(inputs, num_workers, num_seasons, jobs_per_worker=2):
+    with sim_inputs.shared_inputs(inputs) as shared, \
+         concurrent.futures.ProcessPoolExecutor(num_workers, initializer=sim_inputs.attach_inputs, initargs=(shared,)) as executor:
+        # Warm up every worker (imports, caches) before timing
+        list(executor.map(__run_worker_job, [10]*num_workers, range(num_workers)))
+        start = time.perf_counter()
+        total = sum(executor.map(__run_worker_job, [num_seasons]*(num_workers*jobs_per_worker), range(num_workers*jobs_per_worker)))
+        return total / (time.perf_counter() - start)
+
+
+def __print_table(df, title):
+    print(title)
+    with pd.option_context('display.float_format', '{:,.3f}'.format, 'display.width', 200):
+        print(df)
+    print()
+
+
+@app.command()
+def stages(num_seasons: int = 5000, repeat: int = 3, frac_played: float = 0.75):
+    inputs = generate_inputs(frac_played)
+    timings = benchmark_stages(inputs, num_seasons, repeat)
+    __print_table(timings.to_frame('seconds per 1,000 seasons'), f'Stage timings ({num_seasons:,} seasons, best of {repeat})')
+
+
+# season_counts and worker_counts are comma-separated lists
+@app.command()
+def scaling(season_counts: str = '1000,2000,5000,10000', worker_counts: str = None, seasons_per_job: int = 2000,
+            repeat: int = 1, frac_played: float = 0.75, output_path: str = None):
+    inputs = generate_inputs(frac_played)
+    results = {}
+
+    season_counts = [int(n) for n in season_counts.split(',')]
+    by_seasons = pd.DataFrame({n: benchmark_stages(inputs, n, repeat) for n in season_counts}).T
+    by_seasons.index.name = 'seasons'
+    by_seasons['total'] = by_seasons.sum(axis=1)
+    __print_table(by_seasons, 'Seconds per 1,000 seasons, by number of seasons in a chunk')
+    results['seconds_per_1000_seasons'] = by_seasons.to_dict(orient='index')
+
+    if worker_counts is None:
+        worker_counts = ','.join(str(w) for w in [1, 2, 4, 8, 16, 32] if w <= os.cpu_count())
+    throughput = pd.Series({w: benchmark_workers(inputs, w, seasons_per_job) for w in (int(w) for w in worker_counts.split(','))},
+                           name='seasons per second')
+    throughput.index.name = 'workers'
+    by_workers = throughput.to_frame()
+    by_workers['speedup'] = throughput / throughput.iloc[0]
+    __print_table(by_workers, f'Throughput by number of worker processes ({seasons_per_job:,} seasons per job)')
+    results['seasons_per_second_by_workers'] = throughput.to_dict()
+
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+# Fails (with exit code 1) when any stage is more than tolerance slower than in the baseline, or (with exit code 2)
+# when there's no baseline yet; save_baseline writes the current timings as the new baseline instead
+@app.command()
+def check(baseline_path: str = BASELINE_FILENAME, num_seasons: int = 5000, repeat: int = 5, tolerance: float = 0.25,
+          save_baseline: bool = False):
+    if not save_baseline and not os.path.exists(baseline_path):
+        print(f'No baseline at {baseline_path}: run `benchmark.py check --save-baseline` first')
+        raise typer.Exit(code=2)
+    inputs = generate_inputs()
+    timings = benchmark_stages(inputs, num_seasons, repeat)
+
+    if save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump({'num_seasons': num_seasons, 'machine': platform.platform(), 'processor': platform.processor(),
+                       'cpu_count': os.cpu_count(), 'seconds_per_1000_seasons': timings.to_dict()}, f, indent=1)
+        __print_table(timings.to_frame('seconds per 1,000 seasons'), f'Saved baseline to {baseline_path}')
+        return
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    comparison = pd.DataFrame({'baseline': pd.Series(baseline['seconds_per_1000_seasons']), 'current': timings})
+    comparison['change'] = comparison['current'] / comparison['baseline'] - 1
+    comparison['regressed'] = comparison['change'] > tolerance
+    __print_table(comparison, f'Stage timings vs. baseline (seconds per 1,000 seasons; tolerance {tolerance:.0%})')
+    if comparison['regressed'].any():
+        print(f'Regressions in: {", ".join(comparison.index[comparison["regressed"]])}')
+        raise typer.Exit(code=1)
+
+
+# Import module in a fresh interpreter, in an empty directory (so anything that reads input files at import fails)
+# Returns (the wall seconds, the seconds spent in this repo's own modules), per python -X importtime
+def time_import(module):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    own_modules = {f[:-3] for f in os.listdir(repo_dir) if f.endswith('.py')}
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=tmp, capture_output=True,
+                                text=True, env=os.environ | {'PYTHONPATH': repo_dir})
+        seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+    own = 0
+    for match in re.finditer(r'import time:\s+(\d+) \|\s+\d+ \|\s+(\S+)', result.stderr):
+        if match.group(2) in own_modules:
+            own += int(match.group(1))
+    return (seconds, own / 1e6)
+
+
+# Fails (with exit code 1) when importing any of the modules (a comma-separated list) takes more than budget_ms
+# beyond importing numpy and pandas (which everything needs), or when this repo's own code takes more than own_budget
+# (a fraction) of the time numpy and pandas take, which scales the budget with the speed of the machine
+# The timings are the medians of repeat runs, which (unlike the best runs) are stable from one check to the next
+@app.command()
+def startup(modules: str = ','.join(STARTUP_MODULES), repeat: int = 15, budget_ms: float = 150, own_budget: float = 0.1):
+    # The modules are timed in turns, so they all see the same background load
+    modules = ['numpy, pandas'] + modules.split(',')
+    runs = [(module, *time_import(module)) for _ in range(repeat) for module in modules]
+    timings = pd.DataFrame(runs, columns=['module', 'wall', 'own']).groupby('module', sort=False).median() * 1000
+    base = timings.loc['numpy, pandas', 'wall'] / 1000
+    timings = timings.drop('numpy, pandas')
+    timings['beyond pandas'] = timings['wall'] - base*1000
+    timings['over budget'] = (timings['beyond pandas'] > budget_ms) | (timings['own'] > own_budget*base*1000)
+    __print_table(timings, f'Import times (ms, median of {repeat}; numpy and pandas alone take {base*1000:.0f} ms, '
+                           f'so the budget for own code is {own_budget*base*1000:.0f} ms)')
+    if timings['over budget'].any():
+        print(f'Over budget: {", ".join(timings.index[timings["over budget"]])}')
+        raise typer.Exit(code=1)
+
+
+if __name__ == '__main__':
+    app()
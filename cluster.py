@@ -0,0 +1,283 @@
+# Runs a simulation across several hosts: a coordinator hands out jobs to worker processes over sockets
+# (multiprocessing.connection, authenticated with a shared key), and merges what they send back into the usual summary
+#   python cluster.py coordinator --num-jobs ...   on the host that keeps the output
+#   python cluster.py worker <host:port>           on every other host (as many times as it has cores)
+#   python cluster.py local --num-workers 4        a coordinator plus local workers, all on one host
+#
+# The protocol: a worker connects, and receives the inputs and options of the run. It then asks for a job, and keeps
+# sending its result (which asks for the next job) until it is told to stop:
+#   coordinator -> worker: ('inputs', inputs, options), ('job', id, num_seasons, seed), ('stop',)
+#   worker -> coordinator: ('ready',), ('result', id, num_seasons, batches, summary, metrics, seconds), ('error', id, message)
+# Every job is a lease: if its worker disconnects, or doesn't return it within lease_seconds, the job goes back in
+# the queue for another worker. A job's seed only depends on its id, so a rerun job gives the same result, and
+# whichever copy comes back first is kept (a late result from an expired lease is kept or dropped the same way)
+#
+# Trust model: messages are pickled, so anyone who can connect with the authkey can run arbitrary code on the
+# coordinator (and, by forging jobs, on the workers). The authkey (from --authkey or PLAYOFF_ODDS_AUTHKEY) only
+# keeps out those who don't know it; without one, the coordinator generates a random key and prints it, and workers
+# refuse to start. The coordinator listens on localhost by default; only listen on other interfaces (--host) within
+# a trusted network, and treat the key as a secret
+
+import collections
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import secrets
+import shutil
+import socket
+import threading
+import time
+import traceback
+import numpy as np
+import season_simulator as sim
+import sim_inputs
+import sim_output
+import sim_results_processing
+import precision
+import perf_utils
+import parallel_driver
+
+DEFAULT_PORT = 6100
+MAX_ATTEMPTS = 3
+
+
+# The authkey given (or in PLAYOFF_ODDS_AUTHKEY), or None
+def __get_authkey(authkey):
+    authkey = authkey or os.environ.get('PLAYOFF_ODDS_AUTHKEY')
+    return authkey.encode() if authkey else None
+
+
+def __parse_address(address):
+    (host, _, port) = address.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+# Runs jobs for the coordinator at address until it says to stop (or goes away)
+# With ship_output (in the options), a job's standings are sent back too; otherwise just its summary
+def run_worker(address, authkey):
+    with multiprocessing.connection.Client(address, authkey=authkey) as conn:
+        try:
+            (_, inputs, options) = conn.recv()
+            conn.send(('ready',))
+        except (EOFError, OSError):  # the coordinator went away before the first job
+            return
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                return
+            if msg[0] == 'stop':
+                return
+            (_, id, num_seasons, seed) = msg
+            try:
+                output = sim_output.BatchCollector()
+                start = time.perf_counter()
+                with perf_utils.collect_metrics() as metrics:
+                    summary = sim.run_job(inputs, num_seasons, id, options['rating_variation_amt'], save_output=options['ship_output'],
+                                          save_summary=False, output=output, sampling=options['sampling'],
+                                          control_variates=options['control_variates'], seed=seed,
+                                          tiebreak_sample_every=options['tiebreak_sample_every'])
+                msg = ('result', id, num_seasons, output.batches, summary, metrics, time.perf_counter() - start)
+            except Exception:
+                msg = ('error', id, traceback.format_exc())
+            try:
+                conn.send(msg)
+            except OSError:  # the coordinator went away
+                return
+
+
+# Accepts workers' connections (in a background thread), and queues them for the coordinator
+def __accept_workers(listener, new_conns):
+    while True:
+        try:
+            new_conns.put(listener.accept())
+        except multiprocessing.AuthenticationError:
+            continue
+        except OSError:  # the listener was closed
+            return
+
+
+# Hands out num_jobs jobs (sized by parallel_driver.get_job_size_distribution) to the workers that connect to listener
+# Returns the merged summary, and the standard errors of the odds (see precision.py)
+# options are the simulation options sent to the workers (see run_worker)
+# Fails when there are jobs left, but no workers have been connected for worker_timeout seconds
+@perf_utils.print_perf_counter
+def run_coordinator(listener, num_jobs, num_seasons_per_job, options, seed=None, lease_seconds=600, worker_timeout=300):
+    parallel_driver.check_num_seasons_per_job(num_seasons_per_job)
+    seed_seq = np.random.SeedSequence(seed)
+    print(f'Seed: {seed_seq.entropy}')
+    num_seasons_distribution = parallel_driver.get_job_size_distribution(num_seasons_per_job, np.random.default_rng(seed_seq))
+    jobs = collections.deque((id, num_seasons_distribution[id%len(num_seasons_distribution)]) for id in range(num_jobs))
+    attempts = collections.Counter()
+    inputs = sim_inputs.load_inputs()
+
+    new_conns = queue.Queue()
+    threading.Thread(target=__accept_workers, args=(listener, new_conns), daemon=True).start()
+    conns = []
+    idle = []
+    leases = {}  # conn -> (id, num_seasons, deadline)
+    done = set()
+
+    def drop(conn, reason):
+        conn.close()
+        conns.remove(conn)
+        if conn in idle:
+            idle.remove(conn)
+        if conn in leases:
+            (id, num_seasons, _) = leases.pop(conn)
+            print(f'Requeueing job {id}: {reason}')
+            jobs.appendleft((id, num_seasons))
+
+    def send(conn, msg):
+        try:
+            conn.send(msg)
+            return True
+        except OSError as e:
+            drop(conn, f'lost worker ({e})')
+            return False
+
+    summary = None
+    (job_odds, job_sizes) = ([], [])
+    last_connected = time.monotonic()
+    with sim_output.ResultStore() as store:
+        while jobs or leases:
+            while not new_conns.empty():
+                conn = new_conns.get()
+                conns.append(conn)
+                send(conn, ('inputs', inputs, options))
+
+            if conns:
+                last_connected = time.monotonic()
+            elif time.monotonic() - last_connected > worker_timeout:
+                listener.close()
+                raise RuntimeError(f'No workers connected for {worker_timeout}s, with {len(jobs) + len(leases)} jobs left')
+            else:
+                time.sleep(1)
+            for conn in multiprocessing.connection.wait(conns, timeout=1):
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    drop(conn, 'lost worker')
+                    continue
+                if msg[0] == 'result':
+                    (_, id, num_seasons, batches, job_summary, job_metrics, seconds) = msg
+                    leases.pop(conn, None)
+                    if id not in done:  # a job that was requeued can come back twice
+                        done.add(id)
+                        store.write_batches(batches)
+                        summary = sim_results_processing.combine_summaries([summary, job_summary])
+                        job_odds.append(precision.get_odds(job_summary))
+                        job_sizes.append(num_seasons)
+                        print(f'Job {id} done: {num_seasons:,} seasons in {seconds:.1f}s ({len(done)}/{num_jobs} jobs)')
+                elif msg[0] == 'error':
+                    (_, id, message) = msg
+                    attempts[id] += 1
+                    if attempts[id] >= MAX_ATTEMPTS:
+                        raise RuntimeError(f'Job {id} failed {MAX_ATTEMPTS} times; last error:\n{message}')
+                    # An expired lease's job is already back in the queue
+                    if conn in leases:
+                        (_, num_seasons, _) = leases.pop(conn)
+                        jobs.appendleft((id, num_seasons))
+                idle.append(conn)
+
+            # An expired lease's job goes back in the queue, but its worker stays connected, in case it's just slow
+            for (conn, (id, num_seasons, deadline)) in list(leases.items()):
+                if time.monotonic() > deadline:
+                    print(f'Requeueing job {id}: no result within {lease_seconds}s')
+                    del leases[conn]
+                    jobs.appendleft((id, num_seasons))
+
+            while idle and jobs:
+                conn = idle.pop()
+                (id, num_seasons) = jobs.popleft()
+                if id in done:
+                    idle.append(conn)
+                elif send(conn, ('job', id, num_seasons, parallel_driver.get_job_seed(seed_seq, id))):
+                    leases[conn] = (id, num_seasons, time.monotonic() + lease_seconds)
+
+        for conn in list(conns):
+            send(conn, ('stop',))
+        listener.close()
+        store.write(summary, 'summaries', 'all')
+    return (summary, precision.get_standard_errors(job_odds, job_sizes))
+
+
+def __print_results(summary, standard_errors):
+    parallel_driver.summarize_data(summary)
+    if standard_errors is not None:
+        print(f'Odds (%) with 95% confidence intervals, from {summary["len"].max():,.0f} seasons:')
+        print(precision.get_confidence_intervals(summary, standard_errors))
+
+
+def __check_num_seasons_per_job(num_seasons_per_job):
+    try:
+        parallel_driver.check_num_seasons_per_job(num_seasons_per_job)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+def __get_options(rating_variation_amt, sampling, control_variates, ship_output, tiebreak_sample_every):
+    return {'rating_variation_amt': rating_variation_amt, 'sampling': sampling, 'control_variates': control_variates,
+            'ship_output': ship_output, 'tiebreak_sample_every': tiebreak_sample_every}
+
+
+# The commands (typer is imported only when run as a script, see __main__ below)
+
+# Listens on host:port for workers, and runs the simulation on whichever connect (see the trust model above)
+# ship_output has the workers send back their standings (written to output/ here); otherwise just their summaries
+# tiebreak_sample_every (0, off, by default) keeps every nth run's tie-breaking decisions, which are shipped with the standings
+def coordinator(num_jobs: int = 100, num_seasons_per_job: int = 1000, rating_variation_amt: int = 30, host: str = 'localhost',
+                port: int = DEFAULT_PORT, authkey: str = None, lease_seconds: int = 600, worker_timeout: int = 300,
+                ship_output: bool = False, sampling: str = 'independent', control_variates: bool = False, seed: int = None,
+                tiebreak_sample_every: int = 0, clear_output: bool = True):
+    __check_num_seasons_per_job(num_seasons_per_job)
+    if clear_output and os.path.exists(sim_output.OUTPUT_BASEDIR):
+        shutil.rmtree(sim_output.OUTPUT_BASEDIR)
+    options = __get_options(rating_variation_amt, sampling, control_variates, ship_output, tiebreak_sample_every)
+    key = __get_authkey(authkey)
+    if key is None:
+        key = secrets.token_hex(16).encode()
+        print(f'Generated authkey (pass it to the workers with --authkey or PLAYOFF_ODDS_AUTHKEY): {key.decode()}')
+    listener = multiprocessing.connection.Listener((host, port), authkey=key)
+    print(f'Waiting for workers on {socket.gethostname() if host != "localhost" else host}:{port}')
+    __print_results(*run_coordinator(listener, num_jobs, num_seasons_per_job, options, seed, lease_seconds, worker_timeout))
+
+
+# address is the coordinator's host:port; authkey is the coordinator's (or PLAYOFF_ODDS_AUTHKEY)
+def worker(address: str, authkey: str = None):
+    key = __get_authkey(authkey)
+    if key is None:
+        raise SystemExit('Pass the coordinator\'s authkey with --authkey (or PLAYOFF_ODDS_AUTHKEY)')
+    run_worker(__parse_address(address), key)
+
+
+# A coordinator and num_workers worker processes on this host (e.g., for testing)
+def local(num_workers: int = 2, num_jobs: int = 10, num_seasons_per_job: int = 1000, rating_variation_amt: int = 30,
+          lease_seconds: int = 600, ship_output: bool = False, sampling: str = 'independent', control_variates: bool = False,
+          seed: int = None, tiebreak_sample_every: int = 0, clear_output: bool = True):
+    __check_num_seasons_per_job(num_seasons_per_job)
+    if clear_output and os.path.exists(sim_output.OUTPUT_BASEDIR):
+        shutil.rmtree(sim_output.OUTPUT_BASEDIR)
+    options = __get_options(rating_variation_amt, sampling, control_variates, ship_output, tiebreak_sample_every)
+    authkey = os.urandom(16)
+    listener = multiprocessing.connection.Listener(('localhost', 0), authkey=authkey)
+    workers = [multiprocessing.Process(target=run_worker, args=(listener.address, authkey)) for _ in range(num_workers)]
+    for p in workers:
+        p.start()
+    try:
+        results = run_coordinator(listener, num_jobs, num_seasons_per_job, options, seed, lease_seconds)
+    finally:
+        for p in workers:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+    __print_results(*results)
+
+
+if __name__ == '__main__':
+    import typer
+    app = typer.Typer()
+    for command in [coordinator, worker, local]:
+        app.command()(command)
+    app()
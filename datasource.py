@@ -1,4 +1,13 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass
+import numpy as np
 import pandas as pd
+import sim_engine
+import sim_utils
 
 __INPUT_DIR = 'input_data'
 
@@ -21,27 +30,197 @@ def __get_league_structure_impl():
     teams['lg'] = teams['div'].str[0]
     return teams
 
-league_structure = __get_league_structure_impl()
+# Nothing is read or built at import; league_structure is built on first use (as an attribute of the module)
+@functools.cache
+def get_league_structure():
+    return __get_league_structure_impl()
+
+def __getattr__(name):
+    if name == 'league_structure':
+        return get_league_structure()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def get_input_path(filename):
+    return f'{__INPUT_DIR}/{filename}'
 
 def __read_input_table(filename_prefix, index_col):
     df = pd.read_csv(f'{__INPUT_DIR}/{filename_prefix}.csv').set_index(index_col)
     return df
 
-def get_games():
+
+# The input tables are parsed once into a binary snapshot (input_data/snapshot/), with teams as integer codes
+# (their positions in league_structure), which later loads memory-map (so processes share the pages)
+# The snapshot records the mtime, size and hash of the CSVs it was built from, and is rebuilt when they change
+# (a CSV that was only touched, with the same contents, just has its mtime updated)
+# Other processes may have a snapshot's arrays memory-mapped, or be building one too, so arrays are never rewritten
+# in place: each version is built in a directory of its own (input_data/snapshot/<hash>/, built in a temporary one and
+# renamed), and meta.json points to the current one. The version it replaces is kept, for the readers still loading it
+SNAPSHOT_VERSION = 2
+__SNAPSHOT_DIR = f'{__INPUT_DIR}/snapshot'
+__SNAPSHOT_SOURCES = ['cur', 'remain', 'ratings']
+
+
+# arrays holds the played games (played_ids, played_home, played_away, played_score1, played_score2, played_W, played_L),
+# the remaining games (remain_ids, remain_home, remain_away, and remain_dates when known), the head-to-head wins
+# matrix of the played games (played_h2h), and the ratings by team code (NaN for teams without one)
+# source_hash identifies the snapshot's contents, for anything derived from it to tell when it's stale;
+# source_hashes are the sha256s of each of its input tables (by prefix, e.g., 'cur'), for what's derived from only some of them
+@dataclass
+class InputSnapshot:
+    teams: pd.Index
+    arrays: dict
+    source_hash: str
+    source_hashes: dict
+
+
+def __get_source_stat(prefix):
+    st = os.stat(get_input_path(f'{prefix}.csv'))
+    return [st.st_mtime_ns, st.st_size]
+
+
+def __get_file_hash(prefix):
+    with open(get_input_path(f'{prefix}.csv'), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def __build_snapshot():
+    # The sources are hashed before they're read, so a CSV replaced meanwhile makes the snapshot stale, not wrong
+    sources = {prefix: {'stat': __get_source_stat(prefix), 'sha256': __get_file_hash(prefix)} for prefix in __SNAPSHOT_SOURCES}
     played = __read_input_table('cur', 'gamePk')
     remain = __read_input_table('remain', 'gamePk')
+    ratings = __read_input_table('ratings', 'team')['rating']
     # This is a temporary workaround for when the season is completed
     # It pretends some games are still unplayed
-    if remain is not None and len(remain) == 0:
+    if len(remain) == 0:
         total_gms = len(played)
         played = played.head(total_gms-400)
         remain = played.tail(400)[['team1', 'team2']]
 
+    teams = get_league_structure().index
+    arrays = {'played_ids': played.index.to_numpy(np.int64),
+              'played_home': sim_engine.encode_teams(played['team1'], teams),
+              'played_away': sim_engine.encode_teams(played['team2'], teams),
+              'played_score1': played['score1'].to_numpy(np.int64),
+              'played_score2': played['score2'].to_numpy(np.int64),
+              'played_W': sim_engine.encode_teams(played['W'], teams),
+              'played_L': sim_engine.encode_teams(played['L'], teams),
+              'played_h2h': sim_utils.compute_played_h2h(played, teams),
+              'remain_ids': remain.index.to_numpy(np.int64),
+              'remain_home': sim_engine.encode_teams(remain['team1'], teams),
+              'remain_away': sim_engine.encode_teams(remain['team2'], teams),
+              'ratings': ratings.reindex(teams).to_numpy(np.float64)}
+    if 'date' in remain:
+        arrays['remain_dates'] = remain['date'].to_numpy(dtype='datetime64[D]')
+
+    meta = {'version': SNAPSHOT_VERSION, 'teams': list(teams), 'arrays': list(arrays), 'sources': sources}
+    meta['dir'] = __get_snapshot_hash(meta)
+    snapshot_dir = f'{__SNAPSHOT_DIR}/{meta["dir"]}'
+    if not os.path.exists(snapshot_dir):
+        tmp_dir = f'{__SNAPSHOT_DIR}/tmp-{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for (name, arr) in arrays.items():
+            np.save(f'{tmp_dir}/{name}.npy', arr)
+        try:
+            os.replace(tmp_dir, snapshot_dir)
+        except OSError:  # another process built the same version first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    previous = __read_snapshot_meta()
+    __write_snapshot_meta(meta)
+    keep = {meta['dir'], previous.get('dir') if previous else None}
+    for name in os.listdir(__SNAPSHOT_DIR):
+        path = f'{__SNAPSHOT_DIR}/{name}'
+        if os.path.isdir(path) and name not in keep and not name.startswith('tmp-'):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name.endswith('.npy'):  # from before snapshots were versioned
+            os.remove(path)
+
+
+def __read_snapshot_meta():
+    path = f'{__SNAPSHOT_DIR}/meta.json'
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# The meta file is written last, so a snapshot is only used once all its arrays are written
+def __write_snapshot_meta(meta):
+    os.makedirs(__SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = f'{__SNAPSHOT_DIR}/meta.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, f'{__SNAPSHOT_DIR}/meta.json')
+
+
+# A hash of what the snapshot was built from (the CSVs' contents and the league structure)
+def __get_snapshot_hash(meta):
+    sources = {prefix: source['sha256'] for (prefix, source) in meta['sources'].items()}
+    key = {'version': meta['version'], 'teams': meta['teams'], 'sources': sources}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# Whether the snapshot was built from the current CSVs (and the current league structure)
+def __is_snapshot_current(meta):
+    if meta is None or meta['version'] != SNAPSHOT_VERSION or meta['teams'] != list(get_league_structure().index):
+        return False
+    if not os.path.isdir(f'{__SNAPSHOT_DIR}/{meta["dir"]}'):
+        return False
+    touched = False
+    for (prefix, source) in meta['sources'].items():
+        stat = __get_source_stat(prefix)
+        if stat == source['stat']:
+            continue
+        if __get_file_hash(prefix) != source['sha256']:
+            return False
+        (source['stat'], touched) = (stat, True)
+    if touched:
+        __write_snapshot_meta(meta)
+    return True
+
+
+__snapshot = None
+__snapshot_stats = None
+
+
+# The snapshot of the input tables, (re)built if it's stale, and loaded once per process (until the CSVs change)
+def get_snapshot():
+    global __snapshot, __snapshot_stats
+    stats = [__get_source_stat(prefix) for prefix in __SNAPSHOT_SOURCES]
+    if __snapshot is not None and stats == __snapshot_stats:
+        return __snapshot
+
+    meta = __read_snapshot_meta()
+    if not __is_snapshot_current(meta):
+        __build_snapshot()
+        meta = __read_snapshot_meta()
+    arrays = {name: np.load(f'{__SNAPSHOT_DIR}/{meta["dir"]}/{name}.npy', mmap_mode='r') for name in meta['arrays']}
+    __snapshot = InputSnapshot(teams=get_league_structure().index, arrays=arrays, source_hash=meta['dir'],
+                               source_hashes={prefix: source['sha256'] for (prefix, source) in meta['sources'].items()})
+    __snapshot_stats = [__get_source_stat(prefix) for prefix in __SNAPSHOT_SOURCES]
+    return __snapshot
+
+
+def get_games():
+    snapshot = get_snapshot()
+    (arrays, teams) = (snapshot.arrays, snapshot.teams)
+    played = pd.DataFrame({'team1': teams[arrays['played_home']],
+                           'team2': teams[arrays['played_away']],
+                           'score1': arrays['played_score1'],
+                           'score2': arrays['played_score2']},
+                          index=pd.Index(arrays['played_ids'], name='gamePk'))
+    played['margin'] = played['score1'] - played['score2']
+    played['W'] = teams[arrays['played_W']]
+    played['L'] = teams[arrays['played_L']]
+
+    remain = pd.DataFrame({'team1': teams[arrays['remain_home']],
+                           'team2': teams[arrays['remain_away']]},
+                          index=pd.Index(arrays['remain_ids'], name='gamePk'))
+    if 'remain_dates' in arrays:
+        remain['date'] = np.datetime_as_string(arrays['remain_dates'])
     return (played, remain)
 
 def get_ratings():
-    ratings_df = __read_input_table('ratings', 'team')
-    if ratings_df is not None:
-        return ratings_df['rating']
-    else:
-        return None
\ No newline at end of file
+    snapshot = get_snapshot()
+    ratings = pd.Series(snapshot.arrays['ratings'], index=snapshot.teams.rename('team'), name='rating')
+    return ratings.dropna()
@@ -1,3 +1,4 @@
+import functools
 import pandas as pd
 
 def get_games_impl():
@@ -24,13 +25,17 @@ def get_ratings_impl(games):
     ratings = ratings.drop_duplicates().set_index('team')['rating']
     return ratings.sort_values(ascending=False)
 
-(cur, remain, ratings) = get_games_impl()
+# Downloaded on first use (once per process), rather than at import
+@functools.cache
+def __load():
+    return get_games_impl()
 
 def get_games():
+    (cur, remain, _) = __load()
     return (cur, remain)
 
 def get_ratings():
-    return ratings
+    return __load()[2]
 
 
 # This is the source data for the mapping of teams to divisions/leagues
@@ -52,4 +57,11 @@ def get_league_structure_impl():
     teams['lg'] = teams['div'].str[0]
     return teams
 
-league_structure = get_league_structure_impl()
+@functools.cache
+def get_league_structure():
+    return get_league_structure_impl()
+
+def __getattr__(name):
+    if name == 'league_structure':
+        return get_league_structure()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,3 +1,5 @@
+import datetime
+import json
 import pandas as pd
 import numpy as np
 import requests
@@ -6,30 +8,83 @@ import typer
 
 from perf_utils import print_perf_counter 
 
-SCHEDULE_URL = 'https://statsapi.mlb.com/api/v1/schedule'
-TEAMS_URL = 'https://statsapi.mlb.com/api/v1/teams'
+# The MLB stats API; a different base URL (e.g., a local stand-in server) can be given with MLB_STATSAPI_URL
+STATSAPI_URL = os.environ.get('MLB_STATSAPI_URL', 'https://statsapi.mlb.com/api/v1')
 params = {'sportId': 1, 'season': 2025}
 
 __INPUT_DIR = 'input_data'
 
+# The schedule is fetched incrementally: the first update fetches the whole season, and later ones only fetch the
+# days since the last update (plus the games that were rescheduled or suspended in those days), and merge those
+# games into the stored tables. Remaining games that were cancelled, or that are missing from the days fetched, are
+# dropped. The cache holds the last raw schedule response, along with what it was a response to, so the same request
+# (e.g., a second update on the same day) is conditional (If-None-Match/If-Modified-Since), and a 304 (Not Modified)
+# is answered from the cached response
+__SCHEDULE_CACHE_FILENAME = 'schedule_cache.json'
+SCHEDULE_CACHE_VERSION = 1
+
 app = typer.Typer(no_args_is_help=True)
 
-@print_perf_counter
-def __get_games_impl():
-    # Get the MLB schedule from the MLB stats API
-    schedule_data = requests.get(SCHEDULE_URL, params | {'hydrate': 'team'}).json()
+
+def __read_schedule_cache():
+    path = f'{__INPUT_DIR}/{__SCHEDULE_CACHE_FILENAME}'
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        cache = json.load(f)
+    return cache if cache.get('version') == SCHEDULE_CACHE_VERSION else None
+
+
+def __write_schedule_cache(cache):
+    os.makedirs(__INPUT_DIR, exist_ok=True)
+    with open(f'{__INPUT_DIR}/{__SCHEDULE_CACHE_FILENAME}', 'w') as f:
+        json.dump(cache | {'version': SCHEDULE_CACHE_VERSION}, f)
+
+
+# Returns the schedule data and the response; the data is None when the response is 304 (Not Modified)
+def __fetch_schedule(base_url, request_params, cache=None):
+    headers = {}
+    if cache is not None and cache.get('request') == request_params:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+    resp = requests.get(f'{base_url}/schedule', request_params, headers=headers)
+    if resp.status_code == 304:
+        return (None, resp)
+    resp.raise_for_status()
+    return (resp.json(), resp)
+
+
+# Split the regular-season games of schedule data into those played (or in progress) and those remaining
+# Also returns the gamePks of the games that were rescheduled or suspended (whose stubs are removed),
+# and of those that were cancelled (which are removed)
+def __parse_games(schedule_data):
     all_gms = pd.json_normalize(schedule_data['dates'], record_path=['games'])
+    if len(all_gms) == 0:
+        return (None, None, [], [])
     reg = all_gms.query('gameType=="R"')
 
+    cancelled = []
+    if 'status.detailedState' in reg:
+        is_cancelled = reg['status.detailedState'] == 'Cancelled'
+        cancelled = list(reg.loc[is_cancelled, 'gamePk'])
+        reg = reg.loc[~is_cancelled]
+
     # Remove the stubs of games that were rescheduled or suspended
-    if 'resumeDate' in reg:
-        reg = reg.loc[reg.infer_objects().fillna(0).query('resumeDate==0 and rescheduleDate==0').index]
+    moved = []
+    if 'resumeDate' in reg or 'rescheduleDate' in reg:
+        filled = reg.reindex(columns=list(reg.columns) + [c for c in ['resumeDate', 'rescheduleDate'] if c not in reg]).infer_objects().fillna(0)
+        is_stub = (filled['resumeDate'] != 0) | (filled['rescheduleDate'] != 0)
+        moved = list(reg.loc[is_stub, 'gamePk'])
+        reg = reg.loc[~is_stub]
     reg = reg.set_index('gamePk')
 
     # Split out the games that have been played vs those remaining
     played_col_mapper = {'teams.home.team.abbreviation': 'team1', 'teams.away.team.abbreviation': 'team2', 
                         'teams.home.score': 'score1', 'teams.away.score': 'score2'}
-    remain_col_mapper = {'teams.home.team.abbreviation': 'team1', 'teams.away.team.abbreviation': 'team2'}
+    remain_col_mapper = {'teams.home.team.abbreviation': 'team1', 'teams.away.team.abbreviation': 'team2',
+                        'officialDate': 'date'}
     if 'isTie' in reg:
         played = reg.dropna(subset=['isTie']).copy() # filter to include only completed/current games
         played = played[played_col_mapper.keys()].rename(columns=played_col_mapper)
@@ -43,8 +98,83 @@ def __get_games_impl():
     else:
         played = None
         remain = reg[remain_col_mapper.keys()].rename(columns=remain_col_mapper)
+    return (played, remain, moved, cancelled)
+
+
+def __concat(dfs):
+    dfs = [df for df in dfs if df is not None]
+    return pd.concat(dfs) if dfs else None
+
 
-    print(f'Schedule updated: {len(played)} games played and {len(remain)} games remaining') 
+# Replace the stored games (played and remaining) with the new versions of them, add the games that are new,
+# and drop the removed ones (gamePks)
+def __merge_games(stored, new, removed=()):
+    replaced = [pk for df in new if df is not None for pk in df.index] + list(removed)
+    def keep(df):
+        return df[~df.index.isin(replaced)] if df is not None else None
+    played = __concat([keep(stored[0]), new[0]])
+    remain = __concat([keep(stored[1]), new[1]])
+    if played is not None and remain is not None:
+        remain = remain[~remain.index.isin(played.index)]
+    return (played, remain)
+
+
+# The stored (played, remaining) games, either of which is None when there are none (e.g., early or late in the
+# season), or None when neither is stored
+def __read_stored_games():
+    paths = [f'{__INPUT_DIR}/{prefix}.csv' for prefix in ['cur', 'remain']]
+    if not any(os.path.exists(path) for path in paths):
+        return None
+    return tuple(pd.read_csv(path).set_index('gamePk') if os.path.exists(path) else None for path in paths)
+
+
+# full fetches the whole season's schedule, rather than the games since the last update
+@print_perf_counter
+def __get_games_impl(full=False, base_url=None):
+    base_url = base_url or STATSAPI_URL
+    cache = __read_schedule_cache()
+    stored = __read_stored_games()
+    today = datetime.date.today()
+    incremental = (not full and cache is not None and stored is not None
+                   and cache['season'] == params['season'] and cache['base_url'] == base_url)
+
+    request_params = params | {'hydrate': 'team'}
+    if incremental:
+        # From the day before the last update, for the games that were in progress (or late) at the time
+        start = datetime.date.fromisoformat(cache['fetched_through']) - datetime.timedelta(days=1)
+        request_params |= {'startDate': str(start), 'endDate': str(max(today, start))}
+    (schedule_data, resp) = __fetch_schedule(base_url, request_params, cache)
+    (etag, last_modified) = (resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+    if schedule_data is None:
+        print('Schedule unchanged since the last update')
+        schedule_data = cache['response']
+        (etag, last_modified) = (etag or cache['etag'], last_modified or cache['last_modified'])
+
+    (played, remain, moved, cancelled) = __parse_games(schedule_data)
+    if incremental and moved:
+        # The games that were moved to other days (outside the range fetched)
+        (moved_data, _) = __fetch_schedule(base_url, params | {'hydrate': 'team', 'gamePks': ','.join(str(pk) for pk in moved)})
+        (moved_played, moved_remain, _, moved_cancelled) = __parse_games(moved_data)
+        (played, remain) = __merge_games((played, remain), (moved_played, moved_remain), moved_cancelled)
+        cancelled += moved_cancelled
+
+    __write_schedule_cache({'season': params['season'], 'base_url': base_url, 'fetched_through': str(today),
+                            'request': request_params, 'etag': etag, 'last_modified': last_modified,
+                            'response': schedule_data})
+    if incremental:
+        print(f'Fetched {sum(len(df) for df in [played, remain] if df is not None)} games since {request_params["startDate"]}')
+        # The stored remaining games in the days fetched that aren't there anymore (other than those that were moved)
+        # were removed from the schedule
+        fetched = [pk for df in [played, remain] if df is not None for pk in df.index] + moved
+        missing = []
+        stored_remain = stored[1]
+        if stored_remain is not None:
+            in_range = stored_remain['date'].between(request_params['startDate'], request_params['endDate'])
+            missing = list(stored_remain.index[in_range & ~stored_remain.index.isin(fetched)])
+        (played, remain) = __merge_games(stored, (played, remain), cancelled + missing)
+
+    print(f'Schedule updated: {len(played) if played is not None else 0} games played and '
+          f'{len(remain) if remain is not None else 0} games remaining')
     return (played, remain)
 
 
@@ -55,7 +185,7 @@ def __get_games_impl():
 # elo_vs_wpct.ipynb)
 @print_perf_counter
 def __get_ratings_mlb():
-    teams_resp = requests.get(TEAMS_URL, params | {'hydrate': 'standings'}).json()
+    teams_resp = requests.get(f'{STATSAPI_URL}/teams', params | {'hydrate': 'standings'}).json()
     records = pd.json_normalize(teams_resp['teams'], 
                             record_path=['record', 'records', 'expectedRecords'], 
                             meta=['abbreviation', ['record', 'wins'], ['record', 'losses']]).query('type=="xWinLoss"')
@@ -95,9 +225,10 @@ def __write_input_table(df, filename_prefix):
     elif os.path.exists(input_file_path):
         os.remove(input_file_path)
 
+# full refetches the whole season's schedule; base_url overrides the stats API's (see STATSAPI_URL)
 @app.command()
-def update_input_data():
-    cur, remain = __get_games_impl()
+def update_input_data(full: bool = False, base_url: str = None):
+    cur, remain = __get_games_impl(full, base_url)
     ratings = __get_ratings_impl()
 
     __write_input_table(cur, 'cur')
@@ -0,0 +1,65 @@
+import numpy as np
+import sim_utils
+
+# Sizes parallel_driver's jobs as the run goes, from how fast the workers turn out to be
+# A job's time is measured from when it starts in its worker until the parent process has its result, so it includes
+# a fixed overhead (setting up the job, writing out its last output, and returning its summary and metrics) as well as
+# a cost per season. Both are fitted from the jobs completed so far, and each new job is sized:
+#   - big enough that the fixed overhead is at most max_overhead of the job's time
+#   - small enough that, as the run nears its end, the remaining seasons are spread over all the workers
+#     (tail_jobs_per_worker jobs each), so they all finish at about the same time
+# Until the fit is possible, jobs alternate between initial_size and half of it (to measure the fixed overhead)
+# No job is bigger than sim_utils.RUNS_PER_JOB seasons, or its run_ids would collide with the next job's
+# (A job's size doesn't affect its memory: that's bounded by its chunk size, see season_simulator.sim_in_chunks)
+
+class JobScheduler:
+    def __init__(self, total_seasons, num_workers, initial_size, min_size=100, max_overhead=0.05, tail_jobs_per_worker=2):
+        self.total_seasons = total_seasons
+        self.num_workers = num_workers
+        self.initial_size = initial_size
+        self.min_size = min_size
+        self.max_overhead = max_overhead
+        self.tail_jobs_per_worker = tail_jobs_per_worker
+        self.assigned = 0
+        self.num_jobs = 0
+        self.completed = []  # (num_seasons, seconds) of each completed job
+
+    @property
+    def remaining(self):
+        return self.total_seasons - self.assigned
+
+    # Record a completed job: its size, and the seconds from its start (in the worker) until its result was received
+    def record(self, num_seasons, seconds):
+        self.completed.append((num_seasons, seconds))
+
+    # (fixed seconds per job, seconds per season), or None until there are jobs of two different sizes
+    def get_costs(self):
+        if len(set(n for (n, _) in self.completed)) < 2:
+            return None
+        (sizes, seconds) = np.array(self.completed, dtype=float).T
+        (per_season, fixed) = np.polyfit(sizes, seconds, 1)
+        if per_season <= 0:
+            return None
+        return (max(fixed, 0.0), per_season)
+
+    # Seasons per second of one worker
+    def get_throughput(self):
+        (sizes, seconds) = np.array(self.completed, dtype=float).T
+        return sizes.sum() / seconds.sum()
+
+    # The size of the next job (and count its seasons as assigned), or 0 once every season is assigned
+    def next_size(self):
+        if self.remaining <= 0:
+            return 0
+        costs = self.get_costs()
+        if costs is None:
+            size = self.initial_size if self.num_jobs % 2 == 0 else self.initial_size // 2
+        else:
+            (fixed, per_season) = costs
+            amortized = fixed * (1 - self.max_overhead) / (self.max_overhead * per_season)
+            tail = self.remaining / (self.tail_jobs_per_worker * self.num_workers)
+            size = max(min(amortized, tail), self.min_size)
+        size = min(max(int(size), 1), self.remaining, sim_utils.RUNS_PER_JOB)
+        self.assigned += size
+        self.num_jobs += 1
+        return size
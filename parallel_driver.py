@@ -1,21 +1,57 @@
 import concurrent.futures
+import numpy as np
 import pandas as pd
-import typer
-import random
 import shutil
 import os
+import time
+import tracemalloc
 from typing import List
-from rich.progress import Progress, MofNCompleteColumn, TimeElapsedColumn
 
 import season_simulator as sim
+import sim_inputs
+import job_scheduler
+import precision
+import sim_results_processing
 import summarize_results as sr
 import sim_output
+import sim_utils
+import perf_utils
 from perf_utils import print_perf_counter 
 
 
-def sim_seasons(num_seasons: int, id: int, rating_variation_amt: int):
-    sim.main(id = str(id), show_summary=False, num_seasons=num_seasons, rating_variation_amt = rating_variation_amt)
-    return [id, num_seasons]
+# Runs in a worker process, on the inputs attached by the pool's initializer
+# The job writes its output to the result store itself, chunk by chunk, and returns its summary to the parent process,
+# which merges it into the running summary
+# seed is the job's own np.random.SeedSequence (see get_job_seed)
+# The job's metrics (see perf_utils) and when it started (time.time(), so the parent can tell how long it took to get its
+# result) are returned too; profile writes a cProfile of the job to output/profiles
+def sim_seasons(num_seasons: int, id: int, rating_variation_amt: int, save_state: bool, sampling: str, control_variates: bool,
+                seed: np.random.SeedSequence, track_memory: bool = False, profile: bool = False, tiebreak_sample_every: int = 0,
+                chunk_size: int = 5000):
+    started = time.time()
+    profile_path = None
+    if profile:
+        os.makedirs(f'{sim_output.OUTPUT_BASEDIR}/profiles', exist_ok=True)
+        profile_path = f'{sim_output.OUTPUT_BASEDIR}/profiles/{id}.prof'
+    with perf_utils.collect_metrics(track_memory, profile_path) as metrics:
+        summary = sim.run_job(sim_inputs.get_inputs(), num_seasons, id, rating_variation_amt, chunk_size, save_summary=False,
+                              save_state=save_state, sampling=sampling, control_variates=control_variates, seed=seed,
+                              tiebreak_sample_every=tiebreak_sample_every)
+    return [id, num_seasons, summary, metrics, started]
+
+
+# The peak memory (in bytes) per season of simulating and processing a chunk of seasons, measured on a small chunk
+# (it's most of a worker's memory, see season_simulator.sim_in_chunks)
+@print_perf_counter
+def measure_chunk_memory(inputs, rating_variation_amt, sampling, num_seasons=500):
+    tracemalloc.start()
+    try:
+        for _ in sim.sim_in_chunks(inputs, inputs.ratings, num_seasons, num_seasons, sampling=sampling,
+                                   rating_variation_amt=rating_variation_amt, rng=np.random.default_rng(0)):
+            pass
+        return tracemalloc.get_traced_memory()[1] / num_seasons
+    finally:
+        tracemalloc.stop()
 
 
 # We want the jobs to be of varying size, to stagger their start/end times
@@ -24,48 +60,202 @@ def sim_seasons(num_seasons: int, id: int, rating_variation_amt: int):
 # The first number in the distribution is always num_seasons_on_avg,
 # so running one job will work properly (along with every multiple of 10)
 @print_perf_counter
-def get_job_size_distribution(num_seasons_on_avg: int) -> List[int]:
+def get_job_size_distribution(num_seasons_on_avg: int, rng: np.random.Generator) -> List[int]:
     num_steps = 9
     step_size = int(num_seasons_on_avg/(num_steps+1))
     one_way_range = int((num_steps-1)/2)*step_size
     lo = num_seasons_on_avg-one_way_range
     hi = num_seasons_on_avg+one_way_range
     num_seasons_distribution = list(range(lo, hi+step_size, step_size))
-    random.shuffle(num_seasons_distribution)
-    return [num_seasons_on_avg] + num_seasons_distribution
+    return [num_seasons_on_avg] + [int(n) for n in rng.permutation(num_seasons_distribution)]
+
+
+# Fails when get_job_size_distribution (or the first job of a JobScheduler) would make a job of more than
+# sim_utils.RUNS_PER_JOB seasons, whose run_ids would collide with the next job's
+def check_num_seasons_per_job(num_seasons_per_job: int):
+    largest = num_seasons_per_job + 4*int(num_seasons_per_job/10)
+    if largest > sim_utils.RUNS_PER_JOB:
+        raise ValueError(f'num_seasons_per_job makes jobs of up to {largest:,} seasons, '
+                         f'more than the {sim_utils.RUNS_PER_JOB:,} a job can have')
+
+
+# Every job gets an independent random stream, derived from the run's seed and the job's id
+# (so a job's results don't depend on which worker runs it, or when)
+def get_job_seed(seed_seq: np.random.SeedSequence, id: int) -> np.random.SeedSequence:
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key=(id,))
+
 
+# The number of cores this process may run on (os.sched_getaffinity is only available on some platforms, e.g. Linux)
+def get_num_cores() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
+
+# The current odds of each team, from a running summary, best title odds first
+# With standard_errors (see precision.py), the title shows the largest one
+def get_odds_table(summary, standard_errors=None):
+    num_seasons = summary['len'].max()
+    title = f'Odds after {num_seasons:,.0f} seasons'
+    if standard_errors is not None:
+        title += f' (largest standard error: {100*standard_errors.max().max():.2f} pp)'
+    from rich.table import Table  # rich is imported where it's used, so processes that only run jobs don't import it
+    table = Table(title=title)
+    for col in ['team', 'wins', 'playoffs', 'pennant', 'title']:
+        table.add_column(col, justify='right')
+
+    playoffs = summary[[f'r{i}' for i in range(1, 7)]].sum(axis=1)
+    for (team, row) in summary.sort_values(['ws_shares', 'pennant_shares'], ascending=False).iterrows():
+        table.add_row(team, f"{row['sum']/row['len']:.1f}", f"{playoffs[team]/row['len']:.1%}",
+                      f"{row['pennant_shares']/row['len']:.1%}", f"{row['ws_shares']/row['len']:.1%}")
+    return table
+
+
+# summary defaults to the summaries in the result store
 @print_perf_counter
-def summarize_data():
-    summary = sim_output.gather_summaries()
+def summarize_data(summary=None):
+    if summary is None:
+        summary = sim_output.gather_summaries()
     with pd.option_context('display.float_format', '{:,.2f}'.format):
         print(sr.augment_summary(summary))
 
 
+# Returns the summary of all the jobs, which is merged as they complete (and displayed along the way),
+# the standard errors of the odds (see precision.py), and the metrics of all the jobs and of the driver itself
+# (see perf_utils), whose records are also written to output/metrics.jsonl
+# With a target_se (in percentage points), num_jobs is the most jobs to run: jobs are scheduled only
+# until every tracked odd of every team is that precise (after at least min_jobs jobs)
+# With dynamic_sizing, the num_jobs*num_seasons_per_job seasons are split into jobs sized by a job_scheduler.JobScheduler
+# (from the measured throughput), and only a couple of jobs per worker are in flight at a time; otherwise the jobs
+# are sized by get_job_size_distribution. Seeded runs always use the latter, as their results depend on the job sizes
+# num_workers defaults to the number of cores
+# memory_limit_mb limits the memory of the workers' chunks (across all workers): the chunk size is cut to fit a
+# worker's share of it, from measure_chunk_memory. It doesn't count the inputs, or the rest of a worker's process
 @print_perf_counter
-def parallel_driver(num_jobs: int, num_seasons_per_job: int, rating_variation_amt: int):
-    num_seasons_distribution = get_job_size_distribution(num_seasons_per_job)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        def submit_job(id):
-            num_seasons = num_seasons_distribution[id%len(num_seasons_distribution)]
-            return executor.submit(sim_seasons, num_seasons, id, rating_variation_amt)
+def parallel_driver(num_jobs: int, num_seasons_per_job: int, rating_variation_amt: int, save_state: bool = False,
+                    target_se: float = None, min_jobs: int = 10, sampling: str = 'independent', control_variates: bool = False,
+                    seed: int = None, track_memory: bool = False, profile: bool = False, tiebreak_sample_every: int = 0,
+                    dynamic_sizing: bool = True, num_workers: int = None, memory_limit_mb: int = None):
+    check_num_seasons_per_job(num_seasons_per_job)
+    seed_seq = np.random.SeedSequence(seed)
+    print(f'Seed: {seed_seq.entropy}')
+    num_seasons_distribution = get_job_size_distribution(num_seasons_per_job, np.random.default_rng(seed_seq))
+    num_workers = num_workers or get_num_cores()
+    scheduler = None
+    if dynamic_sizing and seed is None:
+        scheduler = job_scheduler.JobScheduler(num_jobs*num_seasons_per_job, num_workers, num_seasons_per_job)
+
+    # The size of job id, or 0 when there are no more jobs to run
+    def get_job_size(id):
+        if scheduler is not None:
+            return scheduler.next_size()
+        return num_seasons_distribution[id%len(num_seasons_distribution)] if id < num_jobs else 0
+
+    # Load and preprocess the inputs once, and share them with every worker
+    inputs = sim_inputs.load_inputs()
+    chunk_size = 5000
+    if memory_limit_mb is not None:
+        bytes_per_season = measure_chunk_memory(inputs, rating_variation_amt, sampling)
+        chunk_size = max(int(min(chunk_size, memory_limit_mb * 2**20 / num_workers / bytes_per_season)), 1)
+        print(f'Chunks of {chunk_size:,} seasons ({bytes_per_season/1000:,.1f} KB per season)')
+    metrics = perf_utils.Metrics()
+    metrics_path = f'{sim_output.OUTPUT_BASEDIR}/metrics.jsonl'
+    with perf_utils.collect_metrics() as driver_metrics, \
+         sim_inputs.shared_inputs(inputs) as shared, sim_output.ResultStore() as store, \
+         concurrent.futures.ProcessPoolExecutor(num_workers, initializer=sim_inputs.attach_inputs, initargs=(shared,)) as executor:
+        def submit_job(id, num_seasons):
+            return executor.submit(sim_seasons, num_seasons, id, rating_variation_amt, save_state, sampling, control_variates,
+                                   get_job_seed(seed_seq, id), track_memory, profile, tiebreak_sample_every, chunk_size)
+
+        # When stopping early, or sizing jobs as they go, only keep enough jobs in flight to keep every worker busy
+        max_in_flight = num_jobs if target_se is None and scheduler is None else 2 * num_workers
+        pending = set()
+        next_id = 0
+        num_seasons = get_job_size(next_id)
 
-        futures = [submit_job(id) for id in range(num_jobs)]
+        from rich.progress import Progress, MofNCompleteColumn, TimeElapsedColumn
+        from rich.console import Group
+        from rich.live import Live
+        progress = Progress(*Progress.get_default_columns(), TimeElapsedColumn(), MofNCompleteColumn())
+        simming = progress.add_task("Simulating seasons", total=num_jobs*num_seasons_per_job)
+        summary = None
+        (job_odds, job_sizes, standard_errors) = ([], [], None)
+        with Live(progress, refresh_per_second=4) as live:
+            while True:
+                precise = (target_se is not None and standard_errors is not None and len(job_odds) >= min_jobs
+                           and 100*standard_errors.max().max() <= target_se)
+                while not precise and num_seasons > 0 and len(pending) < max_in_flight:
+                    pending.add(submit_job(next_id, num_seasons))
+                    next_id += 1
+                    num_seasons = get_job_size(next_id)
+                if not pending:
+                    break
 
-        with Progress(*Progress.get_default_columns(), TimeElapsedColumn(), MofNCompleteColumn()) as progress:
-            simming = progress.add_task("Simulating seasons", total=num_jobs*num_seasons_per_job)
+                (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    (id, job_size, job_summary, job_metrics, started) = f.result()
+                    if scheduler is not None:
+                        scheduler.record(job_size, time.time() - started)
+                    metrics.merge(job_metrics)
+                    perf_utils.count('jobs')
+                    perf_utils.write_records(job_metrics.to_records(job_id=id), metrics_path)
+                    summary = sim_results_processing.combine_summaries([summary, job_summary])
+                    job_odds.append(precision.get_odds(job_summary))
+                    job_sizes.append(job_size)
+                    progress.update(simming, advance=job_size)
+                standard_errors = precision.get_standard_errors(job_odds, job_sizes)
+                live.update(Group(progress, get_odds_table(summary, standard_errors)))
 
-            for f in concurrent.futures.as_completed(futures):
-                progress.update(simming, advance=f.result()[1])
+        store.write(summary, 'summaries', 'all')
+    if scheduler is not None and scheduler.get_costs() is not None:
+        (fixed, per_season) = scheduler.get_costs()
+        print(f'\n{len(job_sizes)} jobs on {num_workers} workers: {scheduler.get_throughput():,.0f} seasons per second per worker, '
+              f'{fixed:.3f}s fixed cost per job, {per_season*1000:.3f}s per 1,000 seasons')
+    perf_utils.write_records(driver_metrics.to_records(job_id='driver'), metrics_path)
+    return (summary, standard_errors, metrics.merge(driver_metrics))
 
 
-def main(num_jobs: int = 1000, num_seasons_per_job: int = 100, rating_variation_amt: int = 30, clear_output: bool = True):
+# save_state keeps the simulated outcomes, so refresh.py can update the odds after new results come in
+# target_se (in percentage points) stops the run once every team's odds are that precise, with num_jobs as the limit
+# sampling (independent, antithetic or stratified) and control_variates are the variance reduction options (see season_simulator.run_job)
+# Ratings are varied for every season (not every job), so the size of the jobs doesn't affect the results
+# seed makes a run reproducible (with a fixed number of jobs, sized by get_job_size_distribution); every run prints the seed it used
+# dynamic_sizing and num_workers control how the work is split into jobs, and memory_limit_mb (in MB, across all workers)
+# how many seasons a worker holds in memory at once (see parallel_driver)
+# show_metrics prints where the time went (across all jobs), track_memory adds peak memory to the metrics,
+# and profile writes a cProfile of every job to output/profiles
+# tiebreak_sample_every keeps the tie-breaking decisions of every nth run in output/tiebreaks (e.g., 100 keeps 1% of them);
+# 0, the default, keeps none
+def main(num_jobs: int = 100, num_seasons_per_job: int = 1000, rating_variation_amt: int = 30, clear_output: bool = True,
+         save_state: bool = False, target_se: float = None, min_jobs: int = 10, sampling: str = 'independent',
+         control_variates: bool = False, seed: int = None, show_metrics: bool = False, track_memory: bool = False,
+         profile: bool = False, tiebreak_sample_every: int = 0, dynamic_sizing: bool = True, num_workers: int = None,
+         memory_limit_mb: int = None):
+    try:
+        check_num_seasons_per_job(num_seasons_per_job)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
     if clear_output and os.path.exists('output'):
         shutil.rmtree('output')
 
-    parallel_driver(num_jobs, num_seasons_per_job, rating_variation_amt)
-    summarize_data()
+    (summary, standard_errors, metrics) = parallel_driver(num_jobs, num_seasons_per_job, rating_variation_amt, save_state, target_se,
+                                                          min_jobs, sampling, control_variates, seed, track_memory, profile,
+                                                          tiebreak_sample_every, dynamic_sizing, num_workers, memory_limit_mb)
+    if show_metrics:
+        with pd.option_context('display.float_format', '{:,.3f}'.format, 'display.width', 200):
+            print(metrics.stages_frame())
+            print(metrics.counters_frame())
+    summarize_data(summary)
+    if standard_errors is not None:
+        print(f'Odds (%) with 95% confidence intervals, from {summary["len"].max():,.0f} seasons:')
+        print(precision.get_confidence_intervals(summary, standard_errors))
+        gains = precision.get_sample_size_gains(summary, standard_errors, metrics.counters['jobs'])
+        if gains is not None:
+            print('Effective sample size per simulated season: ' + ', '.join(f'{m} {g:.2f}x' for (m, g) in gains.items()))
+        else:
+            print(f'(The effective sample size per simulated season needs at least {precision.MIN_GAIN_BATCHES} jobs)')
 
 
 if __name__ == '__main__':
+    import typer
     typer.run(main)
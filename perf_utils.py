@@ -1,4 +1,129 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import sys
 import time
+import tracemalloc
+from collections import Counter
+import pandas as pd
+
+# The resource module (for max_rss) is Unix-only; without it (on Windows), max_rss is 0
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Stage-level metrics: the wall time, CPU time and peak memory of each stage, plus domain counters
+# (ties broken by each rule, runs processed, rows written, ...)
+# Code records into the current Metrics, with perf_utils.stage(name) and perf_utils.count(name), so
+# nothing has to be threaded through; each job collects its own with collect_metrics(), and
+# parallel_driver merges the jobs' metrics
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.counters = Counter()
+
+    # Peak memory is only measured while tracemalloc is tracing (see collect_metrics), and is the peak
+    # since the start of the innermost stage (tracemalloc has only one peak to reset)
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+        (start_wall, start_cpu) = (time.perf_counter(), time.process_time())
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_mem': 0, 'max_rss': 0})
+            stats['calls'] += 1
+            stats['wall'] += time.perf_counter() - start_wall
+            stats['cpu'] += time.process_time() - start_cpu
+            if tracing:
+                stats['peak_mem'] = max(stats['peak_mem'], tracemalloc.get_traced_memory()[1] - start_mem)
+            stats['max_rss'] = max(stats['max_rss'], self.__get_max_rss())
+
+    # The process's peak resident set size, in bytes (ru_maxrss is in bytes on macOS, and in KB elsewhere)
+    def __get_max_rss(self):
+        if resource is None:
+            return 0
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    # Sums the times, calls and counters, and takes the max of the memory figures
+    def merge(self, other):
+        for (name, other_stats) in other.stages.items():
+            stats = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_mem': 0, 'max_rss': 0})
+            for key in ['calls', 'wall', 'cpu']:
+                stats[key] += other_stats[key]
+            for key in ['peak_mem', 'max_rss']:
+                stats[key] = max(stats[key], other_stats[key])
+        self.counters.update(other.counters)
+        return self
+
+    # Structured records (one per stage and one per counter), each tagged with the given fields (e.g. job_id)
+    def to_records(self, **tags):
+        return ([{'type': 'stage', 'name': name, **stats, **tags} for (name, stats) in self.stages.items()] +
+                [{'type': 'counter', 'name': name, 'value': value, **tags} for (name, value) in self.counters.items()])
+
+    def stages_frame(self):
+        return pd.DataFrame.from_dict(self.stages, orient='index').sort_values('wall', ascending=False)
+
+    def counters_frame(self):
+        return pd.Series(self.counters, name='value', dtype='int64').sort_index().to_frame()
+
+
+__current = Metrics()
+
+def get_metrics():
+    return __current
+
+
+def stage(name):
+    return __current.stage(name)
+
+
+def count(name, n=1):
+    __current.count(name, n)
+
+
+# Append records (see Metrics.to_records) to a JSON-lines file
+def write_records(records, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+# Collect the metrics of everything within into a new Metrics (which is yielded)
+# track_memory turns on tracemalloc, which measures peak memory, but slows allocation-heavy code down
+# profile_path runs cProfile over everything within, and writes its stats there
+@contextlib.contextmanager
+def collect_metrics(track_memory=False, profile_path=None):
+    global __current
+    (previous, __current) = (__current, Metrics())
+    profiler = cProfile.Profile() if profile_path is not None else None
+    started_tracing = track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield __current
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if started_tracing:
+            tracemalloc.stop()
+        __current = previous
+
 
 def print_perf_counter(func):
     '''
@@ -6,11 +131,14 @@ def print_perf_counter(func):
     use
     @print_perf_counter
     just above the function you want to time
+    The time is also recorded as a stage of the current metrics
     '''
-    def wrapper(*arg):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
         start = time.perf_counter()
-        result = func(*arg)
+        with stage(func.__name__):
+            result = func(*args, **kwargs)
         end = time.perf_counter()
         print(f'{func.__name__} took {round(end-start, 2)} second(s)')
         return result
-    return wrapper
\ No newline at end of file
+    return wrapper
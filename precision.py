@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+# Precision of the odds, for runs that stop once the odds are precise enough (see parallel_driver --target-se)
+
+# The odds that are tracked, as functions of a summary (see sim_results_processing.summarize_results)
+PRECISION_METRICS = {
+    'playoffs': lambda summary: summary[[f'r{i}' for i in range(1, 7)]].sum(axis=1),
+    'div_wins': lambda summary: summary[[f'r{i}' for i in range(1, 4)]].sum(axis=1),
+    'pennant': lambda summary: summary['pennant_shares'],
+    'title': lambda summary: summary['ws_shares'],
+}
+
+
+# (teams x metrics) frame of the odds from a summary
+def get_odds(summary):
+    return pd.DataFrame({metric: f(summary) / summary['len'] for (metric, f) in PRECISION_METRICS.items()})
+
+
+# Standard errors of the odds of all the jobs combined, by the method of batch means, with each job as a batch
+# The seasons within a job aren't always independent (e.g., antithetic pairs), but the jobs are
+# job_odds is a list of get_odds frames, and job_sizes the number of seasons in each job
+# Returns None until there are at least two jobs
+def get_standard_errors(job_odds, job_sizes):
+    if len(job_odds) < 2:
+        return None
+    teams = job_odds[0].index
+    odds = np.stack([o.reindex(teams).to_numpy() for o in job_odds])
+    weights = (np.asarray(job_sizes, dtype=float) / sum(job_sizes))[:, None, None]
+    mean = (weights * odds).sum(axis=0)
+    var = len(job_odds) / (len(job_odds)-1) * (weights**2 * (odds-mean)**2).sum(axis=0)
+    return pd.DataFrame(np.sqrt(var), index=teams, columns=job_odds[0].columns)
+
+
+# (teams x metrics) frame of the odds, each with its confidence interval (at the z-score z), as percentages
+def get_confidence_intervals(summary, standard_errors, z=1.96):
+    odds = get_odds(summary)
+    return (100*odds).round(1).astype(str) + ' ± ' + (100*z*standard_errors.reindex(odds.index)).round(2).astype(str)
+
+
+# The effective sample size of the playoff and division odds, per simulated season: the number of independent
+# seasons that would give the same standard errors, over the number simulated (the median over the teams whose
+# odds aren't settled). Above 1 means variance reduction is paying off; rating variation pushes it below 1
+# Only these are yes/no outcomes, with a known variance per independent season
+BINOMIAL_METRICS = ['playoffs', 'div_wins']
+
+# The gains are only as good as the standard errors' variances, whose relative error is about sqrt(2/(num_batches-1))
+# (26% with 30 batches), so with fewer than MIN_GAIN_BATCHES batches (jobs) there are none (None)
+MIN_GAIN_BATCHES = 30
+
+def get_sample_size_gains(summary, standard_errors, num_batches, min_odds=0.01):
+    if num_batches < MIN_GAIN_BATCHES:
+        return None
+    odds = get_odds(summary)[BINOMIAL_METRICS]
+    binomial_var = odds * (1-odds) / summary['len'].to_numpy()[:, None]
+    gains = binomial_var / standard_errors.reindex(odds.index)[BINOMIAL_METRICS]**2
+    return gains.where((odds > min_odds) & (odds < 1-min_odds)).median()
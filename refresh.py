@@ -0,0 +1,164 @@
+# Incremental refresh of the playoff odds after new results come in (e.g., after datasource_mlb update_input_data)
+# Instead of starting over, reuse the runs stored by a previous run with --save-state:
+#   The games that have become final drop out of every stored run, and the actual results go into the played standings.
+#   Game outcomes are independent given the ratings, so the rest of each run is still a valid sample of the rest of the season
+#   Each run is then importance-weighted by the likelihood of the actual results under the ratings it was simulated with
+#   (or, with --filter-consistent, only the runs that simulated every new result correctly are kept)
+#   Games that weren't in the stored schedule (e.g., rescheduled ones) are simulated for every stored run
+# Then fresh seasons are simulated until the effective sample size (ESS) reaches target_ess
+#   With rating variation, the weighted runs are a sample of the ratings given the results so far (not of the prior),
+#   so the fresh seasons draw their ratings from the stored runs' (by weight), rather than from rating_variation_amt.
+#   Otherwise, the combined odds would depend on the mix of reused and fresh runs, i.e., on target_ess
+
+import math
+import numpy as np
+import pandas as pd
+import datasource as ds
+import season_simulator as sim
+import sim_engine
+import sim_inputs
+import sim_output
+import sim_results_processing
+import summarize_results as sr
+
+
+def effective_sample_size(weights):
+    return weights.sum()**2 / (weights**2).sum() if weights.sum() > 0 else 0
+
+
+# The log-likelihood of the actual results of the games in sim_results' schedule that have since become final,
+# for each run (under the ratings of that run)
+def get_log_likelihoods(sim_results, played, filter_consistent=False):
+    schedule = sim_results.schedule
+    final = np.isin(schedule.game_ids, played.index)
+    final_ids = schedule.game_ids[final]
+    actual_home_win = (played.loc[final_ids, 'W'] == played.loc[final_ids, 'team1']).to_numpy()
+
+    if filter_consistent:
+        consistent = (sim_results.home_win[:, final] == actual_home_win).all(axis=1)
+        return np.where(consistent, 0.0, -np.inf)
+
+    p_home_win = schedule.win_probs(sim_results.ratings)[..., final]
+    log_likelihoods = np.log(np.where(actual_home_win, p_home_win, 1-p_home_win)).sum(axis=-1)
+    return np.broadcast_to(log_likelihoods, (sim_results.num_seasons,)).copy()
+
+
+# Draws n seasons' ratings (for season_simulator.sim_in_chunks) from ratings, an (m x teams) matrix, by weights
+def get_rating_sampler(ratings, weights):
+    p = weights / weights.sum()
+    return lambda n, rng: ratings[rng.choice(len(ratings), n, p=p)]
+
+
+# Carry the stored runs over to the current remaining schedule
+# Games that are no longer in it (final, or cancelled) are dropped, and games that are new to it are simulated (with rng)
+def condition_on_schedule(sim_results, schedule, rng):
+    if not sim_results.schedule.teams.equals(schedule.teams):
+        raise ValueError('Stored simulations were run with a different set of teams')
+
+    positions = pd.Index(sim_results.schedule.game_ids).get_indexer(schedule.game_ids)
+    known = positions >= 0
+    home_win = np.empty((sim_results.num_seasons, schedule.num_games), dtype=bool)
+    home_win[:, known] = sim_results.home_win[:, positions[known]]
+
+    if not known.all():
+        new_games = sim_engine.Schedule(teams=schedule.teams, game_ids=schedule.game_ids[~known],
+                                        home=schedule.home[~known], away=schedule.away[~known])
+        p_home_win = new_games.win_probs(sim_results.ratings)
+        home_win[:, ~known] = rng.random((sim_results.num_seasons, new_games.num_games)) < p_home_win
+
+    return sim_engine.SimResults(schedule=schedule, home_win=home_win, job_id=sim_results.job_id,
+                                 first_iter=sim_results.first_iter, ratings=sim_results.ratings)
+
+
+# Process one chunk of runs, with their weights, into a weighted summary (writing standings and state along the way)
+# output is a sim_output.ResultStore. The fresh runs' standings have no weight column (it reads as null), as their weight is 1
+def process_weighted_runs(sim_results, weights, inputs, output_id, output, save_output, rng):
+    standings = sim_results_processing.process_sim_results(sim_results, inputs, rng)
+    if save_output:
+        standings['weight'] = np.repeat(weights, sim_results.schedule.num_teams)
+        output.write(standings, 'standings', output_id)
+    with np.errstate(divide='ignore'):
+        sim_output.write_state(sim_results, output_id, np.log(weights))
+    return sim_results_processing.summarize_results(standings, weights)
+
+
+def main(target_ess: int = 100000, filter_consistent: bool = False, rating_variation_amt: int = 30,
+         num_seasons_per_job: int = 1000, chunk_size: int = 5000, save_output: bool = True, show_summary: bool = True,
+         seed: int = None):
+    seed_seq = np.random.SeedSequence(seed)
+    print(f'Seed: {seed_seq.entropy}')
+    # One stream for the reused runs, and one for each job of fresh ones
+    (reused_seed_seq, fresh_seed_seq) = seed_seq.spawn(2)
+    rng = np.random.default_rng(reused_seed_seq)
+    inputs = sim_inputs.load_inputs()
+    (played, remain) = ds.get_games()
+    output_ids = sim_output.list_states()
+
+    # First pass: the updated (unnormalized) log-weights of every stored run
+    log_weights = {}
+    for output_id in output_ids:
+        (sim_results, prior_log_weights) = sim_output.read_state(output_id)
+        log_weights[output_id] = prior_log_weights + get_log_likelihoods(sim_results, played, filter_consistent)
+
+    # Scale the stored weights so they sum to their ESS. A fresh run has weight 1,
+    # so each fresh run then adds one to the ESS of the combined set
+    all_log_weights = np.concatenate(list(log_weights.values())) if log_weights else np.zeros(0)
+    stored_ess = 0
+    if np.isfinite(all_log_weights).any():
+        weights = np.exp(all_log_weights - all_log_weights.max())
+        stored_ess = effective_sample_size(weights)
+        scale = stored_ess / weights.sum()
+        max_log_weight = all_log_weights.max()
+    print(f'Reusing {len(all_log_weights)} stored runs, with an effective sample size of {stored_ess:,.0f}')
+
+    sim_output.clear_output('standings')
+    sim_output.clear_output('summaries')
+
+    # Second pass: carry the runs with any weight over to the current schedule, and summarize them
+    output = sim_output.ResultStore()
+    summary = None
+    next_job_id = 0
+    (stored_ratings, stored_weights) = ([], [])
+    for output_id in output_ids:
+        (sim_results, _) = sim_output.read_state(output_id)
+        next_job_id = max(next_job_id, sim_results.job_id + 1)
+        kept = np.isfinite(log_weights[output_id])
+        if not kept.any():
+            sim_output.remove_state(output_id)
+            continue
+        weights = np.exp(log_weights[output_id][kept] - max_log_weight) * scale
+
+        # Dropped runs are removed; the kept ones are renumbered within the chunk's range of iterations
+        sim_results.home_win = sim_results.home_win[kept]
+        if np.ndim(sim_results.ratings) == 2:
+            sim_results.ratings = sim_results.ratings[kept]
+            stored_ratings.append(sim_results.ratings)
+            stored_weights.append(weights)
+        sim_results = condition_on_schedule(sim_results, inputs.schedule, rng)
+        chunk_summary = process_weighted_runs(sim_results, weights, inputs, output_id, output, save_output, rng)
+        summary = sim_results_processing.combine_summaries([summary, chunk_summary])
+
+    # Top up with fresh simulations
+    rating_sampler = None
+    if stored_ratings:
+        rating_sampler = get_rating_sampler(np.concatenate(stored_ratings), np.concatenate(stored_weights))
+    num_fresh = max(0, math.ceil(target_ess - stored_ess))
+    print(f'Simulating {num_fresh} fresh seasons')
+    for first_season in range(0, num_fresh, num_seasons_per_job):
+        num_seasons = min(num_seasons_per_job, num_fresh - first_season)
+        job_summary = sim.run_job(inputs, num_seasons, next_job_id, rating_variation_amt, chunk_size,
+                                  save_output=save_output, save_summary=False, save_state=True, output=output,
+                                  seed=fresh_seed_seq.spawn(1)[0], rating_sampler=rating_sampler)
+        summary = sim_results_processing.combine_summaries([summary, job_summary])
+        next_job_id += 1
+
+    output.write(summary, 'summaries', 'refresh')
+    output.close()
+    if show_summary:
+        with pd.option_context('display.float_format', '{:,.2f}'.format):
+            print(sr.augment_summary(summary))
+
+
+if __name__ == '__main__':
+    import typer
+    typer.run(main)
@@ -1,60 +1,133 @@
 # Functions that implement the logic for monte carlo playoff odds
 
-import typer
-import pandas as pd
 import numpy as np
-import series_probs_compute as probs
-import datasource as ds
-import sim_utils
+import sim_engine
+import sim_inputs
 import sim_results_processing
 import sim_output
+import sim_utils
+import perf_utils
+import tiebreakers
 import summarize_results as sr
 
 
 
-def sim_n_seasons(games, n):
-    gms = pd.concat([games[['team1', 'team2', 'win_prob']]] * n)
-    gms['iter'] = np.concatenate([np.repeat(i, len(games)) for i in range(n)])
+# Simulate num_seasons in chunks of (at most) chunk_size seasons, processing each chunk into standings,
+# seeds and series shares as it goes. Only one chunk's outcomes are ever in memory
+# inputs is a sim_inputs.SimInputs
+# With rating_variation_amt, every season gets its own draw of ratings, which are used for its games and its playoff series
+# rating_sampler, when given, draws those ratings instead: a function of (n, rng) that returns an (n x teams) matrix of them
+# With antithetic sampling, the two seasons of a pair mirror each other's ratings (or share the sampler's draw), as they do
+# their games' draws (see sim_engine.draw_uniforms); independent ratings would undo much of the pair's negative correlation
+# Every random draw (outcomes, ratings and random tie orders) comes from rng, a np.random.Generator
+# ledger (a tiebreakers.TiebreakLedger) records how the ties were broken
+def sim_in_chunks(inputs, ratings, num_seasons, chunk_size, job_id=0, sampling='independent', rating_variation_amt=0, rng=None,
+                  ledger=None, rating_sampler=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    team_ratings = ratings.reindex(inputs.schedule.teams).to_numpy()
+    win_prob = inputs.schedule.win_probs(team_ratings)
+    for first_iter in range(0, num_seasons, chunk_size):
+        n = min(chunk_size, num_seasons-first_iter)
+        with perf_utils.stage('simulate'):
+            if rating_sampler is not None or rating_variation_amt > 0:
+                if rating_sampler is not None:
+                    season_ratings = rating_sampler(n, rng)
+                    if sampling == 'antithetic':
+                        season_ratings[1::2] = season_ratings[0:n-1:2]
+                else:
+                    season_ratings = add_variation_to_ratings(team_ratings, rating_variation_amt, n, rng, sampling)
+                sim_results = sim_engine.simulate(inputs.schedule, inputs.schedule.win_probs(season_ratings), n, job_id, first_iter, season_ratings, sampling, rng)
+            else:
+                sim_results = sim_engine.simulate(inputs.schedule, win_prob, n, job_id, first_iter, team_ratings, sampling, rng)
+        perf_utils.count('runs', n)
+        standings = sim_results_processing.process_sim_results(sim_results, inputs, rng, ledger=ledger)
+        yield (sim_results, standings)
 
-    rands = np.random.rand(len(gms))
-    gms['W'] = np.where(rands<gms['win_prob'], gms['team1'], gms['team2'])
-    gms['L'] = np.where(rands>gms['win_prob'], gms['team1'], gms['team2'])
-    return gms[['W', 'L', 'iter']]
 
+# With n, returns an (n x teams) matrix of ratings, with a separate draw for each of n seasons
+# With antithetic sampling, seasons come in pairs, where the second season's variation is the negative of the first's
+# (an odd last season is drawn independently), like sim_engine.draw_uniforms does for the games
+def add_variation_to_ratings(ratings, variation_amt = 40, n = None, rng = None, sampling = 'independent'):
+    rng = rng if rng is not None else np.random.default_rng()
+    if n is None:
+        return ratings + rng.normal(0, variation_amt, len(ratings))
+    if sampling != 'antithetic':
+        return np.asarray(ratings) + rng.normal(0, variation_amt, (n, len(ratings)))
+    variation = np.empty((n, len(ratings)))
+    variation[0:n-1:2] = rng.normal(0, variation_amt, (n//2, len(ratings)))
+    variation[1::2] = -variation[0:n-1:2]
+    if n % 2:
+        variation[-1] = rng.normal(0, variation_amt, len(ratings))
+    return np.asarray(ratings) + variation
 
-def compute_probs(gms, ratings):
-    rating1 = pd.merge(left=gms, right=ratings, left_on='team1', right_index=True, how='left')['rating']
-    rating2 = pd.merge(left=gms, right=ratings, left_on='team2', right_index=True, how='left')['rating']
-    return probs.p_game(rating1, rating2)    
-    
-def add_variation_to_ratings(ratings, variation_amt = 40):
-    return ratings + np.random.normal(0, variation_amt, len(ratings))
 
-def main(num_seasons: int = 100, save_output: bool = True, save_summary: bool = True, id: int = 0, show_summary: bool = True, rating_variation_amt: int = 0):
-    (played, remain) = ds.get_games()
-    if len(remain) == 0:
-        raise NotImplementedError("Aborting: simulator doesn't function properly if no games are remaining")
+# Simulate one job from preloaded inputs (a sim_inputs.SimInputs), and return its summary
+# Per-game outcomes are discarded after each chunk, unless save_games is set
+# save_state keeps a compact copy of the outcomes, for refresh.py to reuse
+# output is where the standings, games and summary go: a sim_output.ResultStore, or a sim_output.BatchCollector
+# in a worker process. By default, the job writes to a ResultStore of its own
+# sampling (see sim_engine.SAMPLING_METHODS) and control_variates (see sim_results_processing.summarize_results)
+# are the variance reduction options
+# seed is anything np.random.default_rng takes, e.g., an int or (for parallel jobs) a np.random.SeedSequence of the job's own
+# tiebreak_sample_every keeps the tie-breaking decisions of every nth run, in the 'tiebreaks' output
+# (see tiebreakers.TiebreakLedger); 0, the default, keeps none, as recording them slows down the tie-breaking
+# rating_sampler draws the seasons' ratings in place of rating_variation_amt (see sim_in_chunks)
+def run_job(inputs, num_seasons, id = 0, rating_variation_amt = 0, chunk_size = 5000,
+            save_output = True, save_games = False, save_summary = True, save_state = False, output = None,
+            sampling = 'independent', control_variates = False, seed = None, tiebreak_sample_every = 0, rating_sampler = None):
+    if num_seasons > sim_utils.RUNS_PER_JOB:
+        raise ValueError(f'A job can have at most {sim_utils.RUNS_PER_JOB:,} seasons (its run_ids would collide with the next job\'s)')
+    if output is None:
+        with sim_output.ResultStore() as store:
+            return run_job(inputs, num_seasons, id, rating_variation_amt, chunk_size,
+                           save_output, save_games, save_summary, save_state, store, sampling, control_variates, seed,
+                           tiebreak_sample_every, rating_sampler)
 
-    ratings = ds.get_ratings()
-    if rating_variation_amt > 0:
-        ratings = add_variation_to_ratings(ratings, rating_variation_amt)
-    remain['win_prob'] = compute_probs(remain, ratings)
+    summary = None
+    rng = np.random.default_rng(seed)
+    ledger = tiebreakers.TiebreakLedger(tiebreak_sample_every) if save_output and tiebreak_sample_every > 0 else None
+    chunks = sim_in_chunks(inputs, inputs.ratings, num_seasons, chunk_size, id, sampling, rating_variation_amt, rng, ledger,
+                           rating_sampler)
+    for (chunk_num, (sim_results, standings)) in enumerate(chunks):
+        with perf_utils.stage('write_output'):
+            if save_output:
+                output.write(standings, 'standings', id)
+            if save_games:
+                output.write(sim_results.to_frame(), 'games', id)
+            if save_state:
+                sim_output.write_state(sim_results, f'{id}_{chunk_num}')
+        with perf_utils.stage('summarize_results'):
+            chunk_summary = sim_results_processing.summarize_results(standings, control_variates=control_variates)
+            summary = sim_results_processing.combine_summaries([summary, chunk_summary])
 
-    sim_results = sim_n_seasons(remain, num_seasons)
-    sim_results['job_id'] = id
-    sim_results = sim_utils.add_run_ids(sim_results)
+    if ledger is not None and ledger.rows:
+        output.write(ledger.to_frame(), 'tiebreaks', id)
+    if save_summary:
+        output.write(summary, 'summaries', id)
+    return summary
 
-    standings = sim_results_processing.process_sim_results(sim_results, played, ds.league_structure, ratings)
 
-    if save_output:
-        sim_output.write_output(standings, 'standings', id)
-        sim_output.write_output(sim_results, 'games', id)
-    if save_summary:
-        summary = sim_results_processing.summarize_results(standings)
-        sim_output.write_output(summary, 'summaries', id)
+def main(num_seasons: int = 100, save_output: bool = True, save_summary: bool = True, id: int = 0, show_summary: bool = True, rating_variation_amt: int = 0,
+         chunk_size: int = 5000, save_games: bool = False, save_state: bool = False, sampling: str = 'independent',
+         control_variates: bool = False, seed: int = None, tiebreak_sample_every: int = 0):
+    """
+    Simulate one job of num_seasons seasons, in this process.
+
+    The odds come without confidence intervals or an effective sample size (the payoff of --sampling and --control-variates),
+    as those are estimated across many independent jobs: run parallel_driver.py for them.
+    """
+    if num_seasons > sim_utils.RUNS_PER_JOB:
+        raise typer.BadParameter(f'A job can have at most {sim_utils.RUNS_PER_JOB:,} seasons')
+    inputs = sim_inputs.load_inputs()
+    # Running a job again replaces its output
+    if save_output or save_summary or save_games:
+        sim_output.remove_job_output(id)
+    summary = run_job(inputs, num_seasons, id, rating_variation_amt, chunk_size, save_output, save_games, save_summary, save_state,
+                      sampling=sampling, control_variates=control_variates, seed=seed, tiebreak_sample_every=tiebreak_sample_every)
     if show_summary:
         print(sr.augment_summary(summary))
 
 
 if __name__ == "__main__":
-    typer.run(main) 
\ No newline at end of file
+    import typer
+    typer.run(main)
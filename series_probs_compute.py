@@ -1,7 +1,9 @@
-from scipy.stats import binom
-import pandas as pd
+import functools
+from math import comb
+import numpy as np
 
 # Directly compute probabilities of winning games and series
+# Everything here accepts scalars or NumPy arrays (or pandas Series) of ratings
 
 # This is 538's formula to convert an elo ratings differential into winning probability
 # From https://fivethirtyeight.com/methodology/how-our-nfl-predictions-work/
@@ -15,32 +17,66 @@ def p_game(r_home, r_away):
     return p_from_diff(24 + r_home - r_away)
 
 
-# Compute probability for a 3-game series, where all 3 games are at home for the team with HFA 
-# Binomial chance of winning at least 2 of 3 when all games are at p_g
-def p_series3(r_home, r_away):
-    p_g = p_game(r_home, r_away)
-    p_series = sum([binom.pmf(i, 3, p_g) for i in range(2, 4)])
-    return p_series
+# Where the team with HFA plays each game of a best-of-n series:
+# all 3 at home in the wild card round, 2-2-1 in the LDS, 2-3-2 in the LCS and WS
+HOME_SCHEDULES = {3: 'HHH', 5: 'HHAAH', 7: 'HHAAAHH'}
 
 
-# Generic function for any best-of-n, where n is an odd number,
-# And the HFA team gets (n+1)/2 of those games at home
-# Everything is from the POV of the team with HFA (e.g., p_gh is prob of that team winning at home)
-def p_balanced_series(games, r_home, r_away):
-    gms = {'H': int((games+1)/2)}
-    gms['A'] = gms['H']-1
+# Binomial distribution of wins in num_games games at p_g, along a new last axis
+def __get_distribution(num_games, p_g):
+    wins = np.arange(num_games+1)
+    coeffs = np.array([comb(num_games, i) for i in wins])
+    p_g = np.asarray(p_g, dtype=float)[..., None]
+    return coeffs * p_g**wins * (1-p_g)**(num_games-wins)
+
+
+# Exact probability of the team with HFA winning a best-of-n series (n in HOME_SCHEDULES)
+# The series winner is whoever would win the majority if every game were played,
+# so only the number of home and away games matters, not their order
+# Everything is from the POV of the team with HFA (e.g., p_g['H'] is prob of that team winning at home)
+def p_series_exact(games, r_home, r_away):
+    schedule = HOME_SCHEDULES[games]
+    gms = {'H': schedule.count('H'), 'A': schedule.count('A')}
 
-    p_g = {'H': p_game(r_home, r_away), 
+    p_g = {'H': p_game(r_home, r_away),
            'A': 1 - p_game(r_away, r_home)
         }
 
-    def get_distribution(num_games, p_g):
-        return pd.Series({i: binom.pmf(i, num_games, p_g) for i in range(num_games+1)})
+    (dist_h, dist_a) = [__get_distribution(gms[ha], p_g[ha]) for ha in ['H', 'A']]
+    total = dist_h[..., :, None] * dist_a[..., None, :]
+    wins = np.add.outer(np.arange(gms['H']+1), np.arange(gms['A']+1))
+    return (total * (wins >= (games+1)//2)).sum(axis=(-2, -1))
+
+
+# Series probabilities depend only on the rating difference, so they can be precomputed
+# over a fine, evenly-spaced grid of differences once, and linearly interpolated
+# Differences beyond __TABLE_MAX_DIFF are clamped to the ends of the grid
+__TABLE_MAX_DIFF = 1000
+__TABLE_STEP = 0.5
+
+@functools.cache
+def get_series_table(games):
+    diffs = np.arange(-__TABLE_MAX_DIFF, __TABLE_MAX_DIFF + __TABLE_STEP, __TABLE_STEP)
+    return p_series_exact(games, diffs, 0)
+
 
-    dists = [get_distribution(gms[ha], p_g[ha]) for ha in ['H', 'A']]
-    total = {(i,j): (i+j, dists[0][i]*dists[1][j]) for i in dists[0].keys() for j in dists[1].keys()}
-    ps = pd.DataFrame(total).T.rename(columns = {0: 'w', 1: 'p'}).groupby('w')['p'].sum()
-    return (ps[gms['H']:].sum())
+def p_series_table(games, r_home, r_away):
+    ps = get_series_table(games)
+    diff = np.asarray(r_home, dtype=float) - np.asarray(r_away, dtype=float)
+    pos = np.clip((diff + __TABLE_MAX_DIFF) / __TABLE_STEP, 0, len(ps)-1)
+    i = np.minimum(pos.astype(np.int64), len(ps)-2)
+    frac = pos - i
+    return ps[i] * (1-frac) + ps[i+1] * frac
+
+
+# Compute probability for a 3-game series, where all 3 games are at home for the team with HFA
+def p_series3(r_home, r_away):
+    return p_series_exact(3, r_home, r_away)
+
+
+# Generic function for any best-of-n in HOME_SCHEDULES
+def p_balanced_series(games, r_home, r_away):
+    return p_series_exact(games, r_home, r_away)
 
 
 # Now define funcs for 5 and 7 (for now, just to maintain compatibility with the notebook)
@@ -51,12 +87,7 @@ def p_series5(r_home, r_away):
 def p_series7(r_home, r_away):
     return p_balanced_series(7, r_home, r_away)
 
-series_probs = {}
+
+# Exact odds, at lookup speed
 def p_series(games, r_home, r_away):
-    key = (games, (r_home-r_away))
-    if key not in series_probs:
-        if games == 3:
-            series_probs[key] = p_series3(r_home, r_away)
-        else:
-            series_probs[key] = p_balanced_series(games, r_home, r_away)
-    return series_probs[key]
\ No newline at end of file
+    return p_series_table(games, r_home, r_away)
@@ -0,0 +1,135 @@
+# Integer-encoded simulation kernel
+# Teams are mapped to small integer codes once (their position in the team index),
+# the remaining schedule is kept as int arrays, and every season is drawn at once
+# as an (n_seasons x n_games) matrix of outcomes
+
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+import series_probs_compute as probs
+import sim_utils
+
+
+# Map team names to their integer codes (positions in team_index)
+def encode_teams(team_names, team_index):
+    codes = team_index.get_indexer(team_names)
+    if (codes < 0).any():
+        unknown = sorted(set(np.asarray(team_names)[codes < 0]))
+        raise ValueError(f'Teams not found in league structure: {unknown}')
+    return codes.astype(np.int16)
+
+
+# The remaining schedule, with teams encoded as ints
+# Position i of home/away/game_ids all describe the same game
+@dataclass
+class Schedule:
+    teams: pd.Index
+    game_ids: np.ndarray
+    home: np.ndarray
+    away: np.ndarray
+
+    @property
+    def num_teams(self):
+        return len(self.teams)
+
+    @property
+    def num_games(self):
+        return len(self.game_ids)
+
+    # Probability of the home team winning each game, from ratings by team code
+    def win_probs(self, ratings):
+        ratings = np.asarray(ratings)
+        return probs.p_game(ratings[..., self.home], ratings[..., self.away])
+
+
+def encode_schedule(games, team_index):
+    return Schedule(teams=team_index,
+                    game_ids=games.index.to_numpy(),
+                    home=encode_teams(games['team1'], team_index),
+                    away=encode_teams(games['team2'], team_index))
+
+
+# The remaining schedule of a datasource.InputSnapshot, already encoded (and memory-mapped)
+def snapshot_schedule(snapshot):
+    return Schedule(teams=snapshot.teams,
+                    game_ids=snapshot.arrays['remain_ids'],
+                    home=snapshot.arrays['remain_home'],
+                    away=snapshot.arrays['remain_away'])
+
+
+# The compact output of a simulation: one row per simulated season, one column per remaining game
+# home_win[i, j] is True when the home team (team1) won game j in season i
+# first_iter is the iteration number of the first row, when a job is simulated in several chunks
+# ratings are the ratings the seasons were simulated with, by team code
+@dataclass
+class SimResults:
+    schedule: Schedule
+    home_win: np.ndarray
+    job_id: int = 0
+    first_iter: int = 0
+    ratings: np.ndarray = None
+
+    @property
+    def num_seasons(self):
+        return self.home_win.shape[0]
+
+    @property
+    def iters(self):
+        return self.first_iter + np.arange(self.num_seasons)
+
+    @property
+    def run_ids(self):
+        return sim_utils.get_run_ids(self.job_id, self.iters)
+
+    # (n_seasons x n_games) matrices of team codes
+    def winners(self):
+        return np.where(self.home_win, self.schedule.home, self.schedule.away)
+
+    def losers(self):
+        return np.where(self.home_win, self.schedule.away, self.schedule.home)
+
+    # The per-game DataFrame view (W, L, iter, job_id, run_id, indexed by gamePk)
+    # This materializes a row per simulated game, so it is only for callers who ask for it
+    def to_frame(self):
+        (n, g) = self.home_win.shape
+        teams = self.schedule.teams
+        df = pd.DataFrame({'W': teams[self.winners().ravel()],
+                           'L': teams[self.losers().ravel()],
+                           'iter': np.repeat(self.iters, g)},
+                          index=pd.Index(np.tile(self.schedule.game_ids, n), name='gamePk'))
+        df['job_id'] = self.job_id
+        return sim_utils.add_run_ids(df)
+
+
+# How the uniform draws behind the outcomes are sampled:
+#   independent: every draw is independent
+#   antithetic: seasons come in pairs, where the second season uses 1-u for each of the first season's draws u,
+#     so the two seasons' outcomes are negatively correlated (an odd last season is drawn independently)
+#   stratified: Latin hypercube sampling across seasons; for each game, the n draws fall in a random
+#     permutation of the n equal strata of [0, 1), so every game's home wins are spread evenly over the seasons
+SAMPLING_METHODS = ['independent', 'antithetic', 'stratified']
+
+# rng is a np.random.Generator (a freshly seeded one by default)
+def draw_uniforms(n, num_games, sampling='independent', rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    if sampling == 'independent':
+        return rng.random((n, num_games))
+    elif sampling == 'antithetic':
+        rands = np.empty((n, num_games))
+        rands[0:n-1:2] = rng.random((n//2, num_games))
+        rands[1::2] = 1 - rands[0:n-1:2]
+        if n % 2:
+            rands[-1] = rng.random(num_games)
+        return rands
+    elif sampling == 'stratified':
+        strata = np.argsort(rng.random((n, num_games)), axis=0)
+        return (strata + rng.random((n, num_games))) / n
+    raise ValueError(f'Unknown sampling method {sampling}; expected one of {SAMPLING_METHODS}')
+
+
+# Draw all n seasons in one shot
+# win_prob is the probability of the home team winning each game in the schedule
+def simulate(schedule, win_prob, n, job_id=0, first_iter=0, ratings=None, sampling='independent', rng=None):
+    rands = draw_uniforms(n, schedule.num_games, sampling, rng)
+    home_win = rands < np.asarray(win_prob)
+    return SimResults(schedule=schedule, home_win=home_win, job_id=int(job_id), first_iter=first_iter, ratings=ratings)
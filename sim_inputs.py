@@ -0,0 +1,130 @@
+# The inputs of a simulation job, loaded and preprocessed once
+# parallel_driver loads them in the parent process and shares the arrays with its workers
+# through shared memory, so each job only has to simulate
+
+import contextlib
+import dataclasses
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import datasource as ds
+import sim_engine
+import sim_utils
+import tiebreakers_clinched
+
+
+@dataclass
+class SimInputs:
+    schedule: sim_engine.Schedule      # the remaining games, encoded
+    cur_standings: pd.DataFrame        # standings of the games played so far (None before opening day)
+    played_h2h: np.ndarray             # head-to-head wins matrix of the games played so far
+    ratings: pd.Series
+    league_structure: pd.DataFrame
+    clinched_tie_breakers: dict
+
+
+# The schedule and head-to-head matrix come straight from the input snapshot (see datasource.get_snapshot)
+def load_inputs():
+    snapshot = ds.get_snapshot()
+    (played, remain) = ds.get_games()
+    return build_inputs(played, remain, ds.get_ratings(), ds.league_structure, tiebreakers_clinched.get_clinched_tie_breakers,
+                        sim_engine.snapshot_schedule(snapshot), snapshot.arrays['played_h2h'])
+
+
+# Preprocess the played and remaining games (e.g., synthetic ones; see benchmark.py) into SimInputs
+# get_clinched_tie_breakers is called for the clinched tie-breakers; by default, they're computed from these games
+# schedule and played_h2h, when given, are the games already encoded
+def build_inputs(played, remain, ratings, league_structure, get_clinched_tie_breakers=None, schedule=None, played_h2h=None):
+    if len(remain) == 0:
+        raise NotImplementedError("Aborting: simulator doesn't function properly if no games are remaining")
+
+    teams = league_structure.index
+    cur_standings = None
+    if played is not None and len(played) > 0:
+        cur_standings = sim_utils.compute_standings(played)
+
+    if schedule is None:
+        schedule = sim_engine.encode_schedule(remain, teams)
+    if played_h2h is None:
+        played_h2h = sim_utils.compute_played_h2h(played, teams)
+    if get_clinched_tie_breakers is not None:
+        clinched_tie_breakers = get_clinched_tie_breakers()
+    else:
+        clinched_tie_breakers = tiebreakers_clinched.find_all_clinched_tie_breakers(played_h2h, schedule, league_structure)
+        tiebreakers_clinched.add_known_tie_breakers(clinched_tie_breakers)
+
+    return SimInputs(schedule=schedule,
+                     cur_standings=cur_standings,
+                     played_h2h=played_h2h,
+                     ratings=ratings,
+                     league_structure=league_structure,
+                     clinched_tie_breakers=clinched_tie_breakers)
+
+
+# The arrays that are placed in shared memory, and how to find them in SimInputs
+__SHARED_ARRAYS = {'game_ids': ('schedule', 'game_ids'),
+                   'home': ('schedule', 'home'),
+                   'away': ('schedule', 'away'),
+                   'played_h2h': (None, 'played_h2h')}
+
+
+def __get_array(inputs, location):
+    (parent, attr) = location
+    return getattr(getattr(inputs, parent) if parent else inputs, attr)
+
+
+def __set_array(inputs, location, arr):
+    (parent, attr) = location
+    setattr(getattr(inputs, parent) if parent else inputs, attr, arr)
+
+
+# Copy the arrays of inputs into shared memory blocks, for the lifetime of the context
+# Yields a (picklable) descriptor to pass to attach_inputs in each worker
+@contextlib.contextmanager
+def shared_inputs(inputs):
+    blocks = []
+    specs = {}
+    try:
+        for (name, location) in __SHARED_ARRAYS.items():
+            arr = __get_array(inputs, location)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            blocks.append(shm)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+        # Everything else is small, so it is just pickled along with the descriptor
+        template = dataclasses.replace(inputs, schedule=dataclasses.replace(inputs.schedule))
+        for location in __SHARED_ARRAYS.values():
+            __set_array(template, location, None)
+        yield (specs, template)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+# The inputs of this worker process, when it was started with attach_inputs
+__worker_inputs = None
+__worker_blocks = []
+
+
+# Worker initializer: rebuild SimInputs around views of the parent's shared memory (no copies)
+def attach_inputs(descriptor):
+    global __worker_inputs
+    (specs, template) = descriptor
+    inputs = dataclasses.replace(template, schedule=dataclasses.replace(template.schedule))
+    for (name, (shm_name, shape, dtype)) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        __worker_blocks.append(shm)  # the views are only valid while the block stays open
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arr.flags.writeable = False
+        __set_array(inputs, __SHARED_ARRAYS[name], arr)
+    __worker_inputs = inputs
+
+
+# The inputs attached by attach_inputs, or freshly loaded ones outside a worker
+def get_inputs():
+    if __worker_inputs is not None:
+        return __worker_inputs
+    return load_inputs()
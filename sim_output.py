@@ -1,34 +1,288 @@
 import os
+import json
+import shutil
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import perf_utils
+import sim_engine
+import sim_results_processing
+import sim_utils
 
 
 OUTPUT_BASEDIR = 'output'
 
-def write_output(df, dir_name, job_id):
-    output_dir = f'{OUTPUT_BASEDIR}/{dir_name}'
-    if not os.path.exists (output_dir):
-        os.makedirs(output_dir)
-    df.reset_index().to_feather(f'{output_dir}/{job_id}.feather')
+# pyarrow.parquet and pyarrow.dataset are slow to import (and not needed by every process that imports this
+# module), so they are imported where they're used
+
+# Output (standings, games, summaries and tiebreaks) is stored as a partitioned Parquet dataset per dir_name:
+#   output/<dir_name>/part-<n>.parquet holds the batches of many jobs, zstd-compressed, in row groups of up to ROW_GROUP_SIZE rows
+#   output/<dir_name>/part-<n>.json is the part's manifest entry: its jobs, row count and range of run_ids
+# Several processes can write to a dataset at once: each claims its part numbers by creating the part files exclusively,
+# and a part's entry is written (atomically) only once the part is complete, so readers only ever see complete parts
+# parallel_driver's worker processes write their own parts; cluster.py's workers (on other hosts) collect their batches
+# with a BatchCollector and send them to the coordinator, which writes them
+ROWS_PER_FILE = 10_000_000
+ROW_GROUP_SIZE = 250_000
+MANIFEST_VERSION = 2
+
+# The team/div/lg columns (and, for games, the W/L team names), which are read back dictionary-encoded (as Categoricals)
+DICTIONARY_COLUMNS = ['team', 'div', 'lg', 'W', 'L']
+
+
+def to_table(df):
+    return pa.Table.from_pandas(df.reset_index(), preserve_index=False)
 
 
-def gather_output(dir_name, index_flds):
+# The complete parts' entries, in order
+def read_manifest(dir_name):
     output_dir = f'{OUTPUT_BASEDIR}/{dir_name}'
-    df = pd.concat([pd.read_feather(f'{output_dir}/{filename}') for filename in os.listdir(output_dir)], axis=0)
+    filenames = os.listdir(output_dir) if os.path.exists(output_dir) else []
+    entry_filenames = [f for f in filenames if f.startswith('part-') and f.endswith('.json')]
+    parts = []
+    for filename in sorted(entry_filenames, key=lambda f: int(f.removeprefix('part-').removesuffix('.json'))):
+        with open(f'{output_dir}/{filename}') as f:
+            parts.append(json.load(f))
+    return {'version': MANIFEST_VERSION, 'parts': parts}
+
+
+# One part file of a dataset, with its manifest entry
+class DatasetPart:
+    def __init__(self, dir_name, part_num, schema):
+        self.filename = f'part-{part_num}.parquet'
+        self.schema = schema
+        import pyarrow.parquet as pq
+        self.writer = pq.ParquetWriter(f'{OUTPUT_BASEDIR}/{dir_name}/{self.filename}', schema, compression='zstd')
+        self.entry = {'file': self.filename, 'num_rows': 0, 'jobs': [], 'min_run_id': None, 'max_run_id': None}
+        self.pending = []
+
+    def append(self, table, job_id):
+        table = table.cast(self.schema)
+        self.pending.append(table)
+        self.entry['num_rows'] += len(table)
+        if job_id not in self.entry['jobs']:
+            self.entry['jobs'].append(job_id)
+        if 'run_id' in table.column_names and len(table) > 0:
+            (lo, hi) = (pc.min(table['run_id']).as_py(), pc.max(table['run_id']).as_py())
+            self.entry['min_run_id'] = lo if self.entry['min_run_id'] is None else min(lo, self.entry['min_run_id'])
+            self.entry['max_run_id'] = hi if self.entry['max_run_id'] is None else max(hi, self.entry['max_run_id'])
+        if sum(len(t) for t in self.pending) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.writer.write_table(pa.concat_tables(self.pending), row_group_size=ROW_GROUP_SIZE)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+# Appends batches of output to the datasets, e.g.
+#   with ResultStore() as store:
+#       store.write(standings, 'standings', job_id)
+# A part's manifest entry is written when the part is closed (when it's full, or the store is closed)
+class ResultStore:
+    def __init__(self):
+        self.__parts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, df, dir_name, job_id):
+        self.write_table(to_table(df), dir_name, job_id)
+
+    def write_table(self, table, dir_name, job_id):
+        # A batch with different columns (e.g., refresh.py's weighted standings) starts a new part
+        part = self.__parts.get(dir_name)
+        if part is not None and (part.entry['num_rows'] >= ROWS_PER_FILE or table.column_names != part.schema.names):
+            self.__close_part(dir_name)
+            part = None
+        if part is None:
+            part = self.__open_part(dir_name, table.schema)
+        part.append(table, job_id)
+        perf_utils.count(f'rows_written.{dir_name}', len(table))
+        perf_utils.count(f'bytes_written.{dir_name}', table.nbytes)
+
+    # Write the batches collected by a BatchCollector
+    def write_batches(self, batches):
+        for (table, dir_name, job_id) in batches:
+            self.write_table(table, dir_name, job_id)
+
+    def close(self):
+        for dir_name in list(self.__parts):
+            self.__close_part(dir_name)
+
+    def __open_part(self, dir_name, schema):
+        os.makedirs(f'{OUTPUT_BASEDIR}/{dir_name}', exist_ok=True)
+        part = DatasetPart(dir_name, self.__claim_part_num(dir_name), schema)
+        self.__parts[dir_name] = part
+        return part
+
+    # Claims the first free part number, by creating its (empty) part file
+    def __claim_part_num(self, dir_name):
+        part_num = 0
+        while True:
+            try:
+                with open(f'{OUTPUT_BASEDIR}/{dir_name}/part-{part_num}.parquet', 'x'):
+                    return part_num
+            except FileExistsError:
+                part_num += 1
+
+    def __close_part(self, dir_name):
+        part = self.__parts.pop(dir_name)
+        part.close()
+        path = f'{OUTPUT_BASEDIR}/{dir_name}/{part.filename.removesuffix(".parquet")}.json'
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(part.entry, f, indent=1)
+        os.replace(f'{path}.tmp', path)
+
+
+# Removes a job's batches from every dataset, so a job that's run again replaces its output rather than adding to it
+# A part that holds other jobs' batches too is rewritten (as a new part) without the job's runs, by their run_ids
+def remove_job_output(job_id):
+    if not os.path.exists(OUTPUT_BASEDIR):
+        return
+    import pyarrow.parquet as pq
+    dir_names = [d for d in sorted(os.listdir(OUTPUT_BASEDIR)) if os.path.isdir(f'{OUTPUT_BASEDIR}/{d}')]
+    for dir_name in dir_names:
+        for entry in read_manifest(dir_name)['parts']:
+            if job_id not in entry['jobs']:
+                continue
+            path = f'{OUTPUT_BASEDIR}/{dir_name}/{entry["file"]}'
+            others = [j for j in entry['jobs'] if j != job_id]
+            if others:
+                if entry['min_run_id'] is None:
+                    raise ValueError(f"Can't separate job {job_id}'s batches from those of jobs {others} in {path}")
+                table = pq.read_table(path)
+                with ResultStore() as store:
+                    for other in others:
+                        run_ids = (sim_utils.get_run_ids(other, 0), sim_utils.get_run_ids(other, sim_utils.RUNS_PER_JOB-1))
+                        in_other = (pc.field('run_id') >= run_ids[0]) & (pc.field('run_id') <= run_ids[1])
+                        store.write_table(table.filter(in_other), dir_name, other)
+            # The entry goes first, so readers never see a part that's gone
+            os.remove(path.removesuffix('.parquet') + '.json')
+            os.remove(path)
+
+
+# Stands in for a ResultStore in worker processes that can't write to the output directory: collects the batches
+# (as Arrow tables), to be sent to the process that can, and passed to ResultStore.write_batches
+# It holds the whole job's output, so the job's size (not its chunk size) bounds the memory it takes
+class BatchCollector:
+    def __init__(self):
+        self.batches = []
+
+    def write(self, df, dir_name, job_id):
+        self.batches.append((to_table(df), dir_name, job_id))
+
+
+# A lazy view of a dataset, for scanning it in batches or with custom filters
+# run_ids is a (first, last) range; parts the manifest shows to be entirely outside it are skipped
+def open_dataset(dir_name, run_ids=None):
+    import pyarrow.dataset as pads
+    import pyarrow.parquet as pq
+    parts = read_manifest(dir_name)['parts']
+    if run_ids is not None:
+        (first, last) = run_ids
+        parts = [p for p in parts if p['min_run_id'] is None or (p['min_run_id'] <= last and p['max_run_id'] >= first)]
+    paths = [f'{OUTPUT_BASEDIR}/{dir_name}/{p["file"]}' for p in parts]
+
+    # The parts' schemas are unified, so columns missing from some parts read as nulls
+    schema = pa.unify_schemas([pq.read_schema(path) for path in paths]) if paths else pa.schema([])
+    for col in DICTIONARY_COLUMNS:
+        if col in schema.names and pa.types.is_string(schema.field(col).type):
+            schema = schema.set(schema.get_field_index(col), pa.field(col, pa.dictionary(pa.int32(), pa.string())))
+    file_format = pads.ParquetFileFormat(read_options=pads.ParquetReadOptions(dictionary_columns=DICTIONARY_COLUMNS))
+    return pads.dataset(paths, schema=schema, format=file_format)
+
+
+# Read (a projection of) a dataset into a DataFrame
+# Only the columns given (plus index_flds) are read, and the filter (a pyarrow.compute expression) is pushed down to the scan
+def gather_output(dir_name, index_flds, columns=None, filter=None, run_ids=None):
+    dataset = open_dataset(dir_name, run_ids)
+    if run_ids is not None:
+        run_id_filter = (pc.field('run_id') >= run_ids[0]) & (pc.field('run_id') <= run_ids[1])
+        filter = run_id_filter if filter is None else filter & run_id_filter
+    if columns is not None:
+        columns = list(index_flds or []) + [c for c in columns if c not in (index_flds or [])]
+    if not dataset.files:  # nothing written yet: there's no schema to scan (or filter) with
+        df = pd.DataFrame(columns=columns if columns is not None else list(index_flds or []))
+    else:
+        df = dataset.to_table(columns=columns, filter=filter).to_pandas()
     if index_flds:
         df = df.set_index(index_flds)
     return df
 
 
-def gather_results():
-    return gather_output('standings', ['run_id', 'team'])
+# teams limits the standings to those teams; run_ids is a (first, last) range
+def gather_results(columns=None, teams=None, run_ids=None):
+    filter = pc.field('team').isin(teams) if teams is not None else None
+    return gather_output('standings', ['run_id', 'team'], columns, filter, run_ids)
 
 
 def gather_summaries():
-    summaries = gather_output('summaries', None)
-    summary = summaries.groupby('team').sum()
-    summary['max'] = summaries.groupby('team')['max'].max()
-    summary['min'] = summaries.groupby('team')['min'].min()
-    return summary
-
-def gather_games():
-    return gather_output('games', ['run_id', 'gamePk'])
\ No newline at end of file
+    summaries = gather_output('summaries', ['team'])
+    summaries.index = summaries.index.astype(str)
+    return sim_results_processing.combine_summaries([summaries])
+
+
+# The tie-breaking decisions (see tiebreakers.TiebreakLedger); rule limits them to the ties decided by that rule
+def gather_tiebreaks(columns=None, rule=None, run_ids=None):
+    filter = (pc.field('rule') == rule) if rule is not None else None
+    return gather_output('tiebreaks', ['run_id'], columns, filter, run_ids)
+
+
+# teams limits the games to those involving (winning or losing) any of those teams
+def gather_games(columns=None, teams=None, run_ids=None):
+    filter = (pc.field('W').isin(teams) | pc.field('L').isin(teams)) if teams is not None else None
+    return gather_output('games', ['run_id', 'gamePk'], columns, filter, run_ids)
+
+
+# The compact state of a chunk of simulated seasons (outcomes, ratings and run weights),
+# so the runs can be reused later (see refresh.py). Outcomes are stored as packed bits
+def write_state(sim_results, output_id, log_weights=None):
+    output_dir = f'{OUTPUT_BASEDIR}/state'
+    if not os.path.exists (output_dir):
+        os.makedirs(output_dir)
+    if log_weights is None:
+        log_weights = np.zeros(sim_results.num_seasons)
+    schedule = sim_results.schedule
+    np.savez_compressed(f'{output_dir}/{output_id}.npz',
+                        teams=schedule.teams.to_numpy(dtype=str), game_ids=schedule.game_ids,
+                        home=schedule.home, away=schedule.away,
+                        home_win=np.packbits(sim_results.home_win, axis=1),
+                        job_id=sim_results.job_id, first_iter=sim_results.first_iter,
+                        ratings=sim_results.ratings, log_weights=log_weights)
+
+
+def list_states():
+    output_dir = f'{OUTPUT_BASEDIR}/state'
+    if not os.path.exists(output_dir):
+        return []
+    return sorted(filename.removesuffix('.npz') for filename in os.listdir(output_dir))
+
+
+# Returns (sim_engine.SimResults, log_weights) for a state written by write_state
+def read_state(output_id):
+    with np.load(f'{OUTPUT_BASEDIR}/state/{output_id}.npz') as state:
+        schedule = sim_engine.Schedule(teams=pd.Index(state['teams']), game_ids=state['game_ids'],
+                                       home=state['home'], away=state['away'])
+        home_win = np.unpackbits(state['home_win'], axis=1, count=schedule.num_games).astype(bool)
+        sim_results = sim_engine.SimResults(schedule=schedule, home_win=home_win, job_id=int(state['job_id']),
+                                            first_iter=int(state['first_iter']), ratings=state['ratings'])
+        return (sim_results, state['log_weights'])
+
+
+def remove_state(output_id):
+    os.remove(f'{OUTPUT_BASEDIR}/state/{output_id}.npz')
+
+
+def clear_output(dir_name):
+    output_dir = f'{OUTPUT_BASEDIR}/{dir_name}'
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
\ No newline at end of file
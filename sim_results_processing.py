@@ -1,73 +1,113 @@
+import functools
 import pandas as pd
+import perf_utils
 import tiebreakers
+import tiebreaker_impls
 import sim_utils
 import numpy as np
-import series_probs_approx as probs
-import functools
-import datasource as ds
+import series_probs_compute as probs
 
 # Merge in league structure, and compute playoff seeding
-def process_sim_results(sim_results, played, league_structure, ratings):
-    cur_standings = None
-    if played is not None and len(played) > 0:
-        cur_standings = sim_utils.compute_standings(played)
-
-    standings = sim_utils.compute_standings_from_results(sim_results, cur_standings).reset_index()
-    job_id = sim_results.iloc[0]['job_id']
-    standings['job_id'] = job_id
-
-    standings = sim_utils.add_run_ids(standings)
-
-    # Merge in the div/lg data
-    standings = pd.merge(left=standings, right=league_structure, left_on='team', right_index=True)
-    standings = standings.set_index(['run_id', 'team'])[['W', 'L', 'wpct', 'div', 'lg']]
-
-    # Merge in the ratings
-    standings = pd.merge(left=standings, right=ratings, left_on='team', right_index=True)
+# sim_results is a sim_engine.SimResults (with its ratings), and inputs the sim_inputs.SimInputs it was simulated from
+# rng (a np.random.Generator) is for the random ordering of unbreakable ties
+# stage(name) is a context manager wrapped around each stage of the processing, to measure it (see perf_utils)
+# ledger (a tiebreakers.TiebreakLedger) records how the ties were broken
+def process_sim_results(sim_results, inputs, rng=None, stage=perf_utils.stage, ledger=None):
+    league_structure = inputs.league_structure
+    with stage('standings'):
+        standings = sim_utils.compute_standings_from_results(sim_results, inputs.cur_standings)
+
+        # Broadcast the div/lg data and the ratings to every simulated season
+        teams = standings.index.get_level_values('team')
+        standings['div'] = league_structure['div'].reindex(teams).to_numpy()
+        standings['lg'] = league_structure['lg'].reindex(teams).to_numpy()
+        ratings_shape = (sim_results.num_seasons, sim_results.schedule.num_teams)
+        standings['rating'] = np.broadcast_to(sim_results.ratings, ratings_shape).ravel()
+        standings['xW'] = sim_utils.compute_expected_wins(sim_results, inputs.cur_standings).ravel()
+
+    # Head-to-head and split records, in case any ties need to be broken
+    records = tiebreaker_impls.TiebreakRecords(sim_results, inputs.played_h2h, league_structure, inputs.clinched_tie_breakers, rng, ledger)
 
     # compute div_wins and playoff seeds
-    add_division_winners(standings, sim_results, played)
-    add_lg_ranks(standings, sim_results, played)
-    add_series_shares(standings, [], 'lds_shares', 0)
-    add_series_shares(standings, ['lds_shares'], 'lcs_shares', 1)
-    add_series_shares(standings, ['lcs_shares'], 'pennant_shares', 2)
-    add_ws_shares(standings)
-    add_p_home_game(standings)
+    with stage('add_division_winners'):
+        add_division_winners(standings, records)
+    with stage('add_lg_ranks'):
+        add_lg_ranks(standings, records)
+    with stage('series_shares'):
+        num_teams = sim_results.schedule.num_teams
+        seeds = get_seeds(standings, num_teams, get_playoff_format()[['TmH', 'TmA']].max().max())
+        shares = add_series_shares(standings, seeds, num_teams)
+        add_ws_shares(standings, seeds, shares[-1], num_teams)
+        add_p_home_game(standings)
     return standings
 
-def summarize_results(standings):
-    counts = standings.reset_index()[['team', 'lg_rank']].value_counts().unstack()
-    wins = standings.groupby('team')['W'].agg(['sum', 'max', 'min', len])
-    for col in ['pennant_shares', 'lds_shares', 'lcs_shares', 'ws_shares', 'p_home_game']:
-        wins[col] = standings.groupby('team')[col].sum()
+SUMMARY_SHARES = ['pennant_shares', 'lds_shares', 'lcs_shares', 'ws_shares', 'p_home_game']
+
+# weights (one per run, in the order of the runs in standings) make this a weighted summary,
+# where counts, sums and 'len' are all sums of weights (see refresh.py)
+# control_variates adjusts the counts and sums with each team's wins as a control variate (see __apply_control_variates)
+def summarize_results(standings, weights=None, control_variates=False):
+    if control_variates and weights is not None:
+        raise ValueError('Control variates are not supported for weighted summaries')
+    df = standings[['W', 'xW', 'lg_rank'] + SUMMARY_SHARES].reset_index()
+    df['weight'] = 1 if weights is None else np.repeat(weights, len(df) // len(weights))
+    for col in ['W'] + SUMMARY_SHARES:
+        df[f'weighted_{col}'] = df[col] * df['weight']
+
+    counts = df.groupby(['team', 'lg_rank'])['weight'].sum().unstack()
+    by_team = df.groupby('team')
+    wins = pd.DataFrame({'sum': by_team['weighted_W'].sum(),
+                         'max': df[df['weight']>0].groupby('team')['W'].max(),
+                         'min': df[df['weight']>0].groupby('team')['W'].min(),
+                         'len': by_team['weight'].sum()})
+    for col in SUMMARY_SHARES:
+        wins[col] = by_team[f'weighted_{col}'].sum()
+    if control_variates:
+        (wins, counts) = __apply_control_variates(df, wins, counts)
     summary = pd.merge(left=wins, right=counts, on='team', how='left')
     for col in counts.columns:
-        summary[col] = summary[col].fillna(0).astype(int)
+        summary[col] = summary[col].fillna(0).astype(counts[col].dtype if weights is not None or control_variates else int)
     
     return summary.rename(columns={i: f'r{i}' for i in range(100)})
 
 
-def break_all_ties(tied_sets, sim_results, played):
-    @functools.cache
-    def get_games(run_id):
-        cols = ['W', 'L']
-        simmed = sim_results[sim_results['run_id']==run_id]
-        games = pd.concat([played[cols], simmed[cols]]) if len(played)>0 else simmed[cols]
-        league_structure = ds.league_structure
-        df = pd.merge(left=games, right=league_structure, left_on='W', right_index=True)
-        df = pd.merge(left=df, right=league_structure, left_on='L', right_index=True, suffixes=["_W", "_L"])
-        return df
-
-    def break_one_tie(row):
-        games = get_games(row['run_id'])
-        return tiebreakers.break_tie(row['team'], games)
-    
-    tie_orders =  pd.Series(tied_sets.reset_index().apply(break_one_tie, axis=1)).rename('team')
-    tie_orders.index = tied_sets.index
-    return tie_orders
+# A team's simulated wins, less its expected wins (xW), have a known mean of zero, and are correlated with its odds
+# So each count and sum Y is adjusted to sum(Y) - beta*sum(W - xW), where beta is the (per-team) regression coefficient
+# of Y on W - xW. That cuts the variance of the estimate by a factor of 1-rho^2, where rho is their correlation
+def __apply_control_variates(df, wins, counts):
+    resid = df['W'] - df['xW']
+    centered = resid - resid.groupby(df['team']).transform('mean')
+    var = (centered**2).groupby(df['team']).sum()
+    scale = (resid.groupby(df['team']).sum() / var).where(var > 0, 0)
+
+    wins = wins.copy()
+    wins['sum'] -= (df['W'] * centered).groupby(df['team']).sum() * scale
+    for col in SUMMARY_SHARES:
+        wins[col] -= (df[col] * centered).groupby(df['team']).sum() * scale
+    counts = counts.astype(float) - centered.groupby([df['team'], df['lg_rank']]).sum().unstack().fillna(0).mul(scale, axis=0)
+    return (wins, counts)
+
 
+# Combine summaries of separate sets of runs (e.g., chunks or jobs) into one summary
+# Entries of None are skipped, so a running summary can start out empty
+def combine_summaries(summaries):
+    summaries = pd.concat([s for s in summaries if s is not None])
+    summary = summaries.groupby('team').sum()
+    summary['max'] = summaries.groupby('team')['max'].max()
+    summary['min'] = summaries.groupby('team')['min'].min()
+    return summary
 
-def add_division_winners(standings, sim_results, played):
+
+# tied_sets is a Series of sets of tied team names, indexed by (at least) run_id
+# Returns a Series (with the same index) of the tie-broken orderings, as lists of team names
+def break_all_ties(tied_sets, records):
+    runs = records.get_runs(tied_sets.index.get_level_values('run_id'))
+    tms = records.teams
+    orders = [list(tms[tiebreakers.break_tie(tms.get_indexer(list(teams)), records, run)]) for (teams, run) in zip(tied_sets, runs)]
+    return pd.Series(orders, index=tied_sets.index, name='team', dtype=object)
+
+
+def add_division_winners(standings, records):
     standings['div_win'] = False
 
     div_leading_wpct = standings.groupby(['run_id', 'div'])['wpct'].transform('max')
@@ -82,22 +122,22 @@ def add_division_winners(standings, sim_results, played):
     if len(tied_teams)>0:
         tied_sets = tied_teams.groupby(['run_id', 'div'])['team'].apply(set)
         # For each tied set, we just want the ['run_id', 'team'] of the winner, so we can set the div_win flag
-        tie_winners = break_all_ties(tied_sets, sim_results, played).apply(lambda s: s[0]).reset_index().set_index(['run_id', 'team']).index
+        tie_winners = break_all_ties(tied_sets, records).apply(lambda s: s[0]).reset_index().set_index(['run_id', 'team']).index
         standings.loc[tie_winners, 'div_win'] = True
     return standings
 
 
-def add_lg_ranks(standings, sim_results, played):
+def add_lg_ranks(standings, records):
     idx_cols = ['run_id', 'lg']
     rank_cols = ['div_win', 'wpct']
     tied_tm_ct = standings.groupby(idx_cols + rank_cols)['wpct'].transform('size')
     if sum(tied_tm_ct) > 0:
         tied_sets = standings[tied_tm_ct>1].reset_index().groupby(idx_cols + rank_cols)['team'].apply(set)
-        tie_orders = break_all_ties(tied_sets, sim_results, played).explode()
+        tie_orders = break_all_ties(tied_sets, records).explode()
         # We need to take tie-orders (which are ordered lists) and convert them into a number we can use for sorting
         tiebreak = (15 - tie_orders.groupby(idx_cols + rank_cols).cumcount())
         standings['tiebreak'] = pd.concat([tie_orders, tiebreak], axis=1).reset_index().set_index(['run_id', 'team'])[0]
-        standings.fillna({'tiebreak': 0}, inplace=True)
+        standings['tiebreak'] = standings['tiebreak'].fillna(0).astype(int)
     else:
         standings['tiebreak'] = 0
 
@@ -108,101 +148,107 @@ def add_p_home_game(standings):
     standings['p_home_game'] = np.where(standings['lg_rank']<=4, 1, standings['lds_shares'])
 
 
-playoff_format = pd.read_csv('playoff_format.csv')
-
-# This method computes the probabilities of advancement for a round of playoffs
-# We've already enumerated all the possible matchups by seed (playoff_format). Then:
-#   Merge that with the actual playoff fields from each run, to get
-#     each possible team-vs-team matchup for each run.
-#   Compute the likelihood of each team winning that series
-#   Compute the probability of each series happening (e.g., both teams advancing to this round)
-#   Combine the last two steps to compute the likelihood of each team advancing beyond this round
-def add_series_shares(standings, likelihood_field_name, share_name, round_num):
-    # Create a table with all the series to model
-    potential_series = playoff_format.query('Round==@round_num')
-    potential_series.columns = pd.MultiIndex.from_tuples([('Round', ''), ('Length', ''), ('h', 'seed'), ('a', 'seed')])
-    series_teams = potential_series.reset_index().set_index(['index', 'Round', 'Length']).stack(0, future_stack=True)
-
-    playoff_fields = standings.query('lg_rank<=6').rename(columns={'lg_rank': 'seed'})
-
-    cols = ['run_id', 'team', 'wpct', 'lg', 'rating', 'seed', 'index', 'Round', 'Length', 'level_3'] + likelihood_field_name
-    col_mapper = {'index': 'series_id', 'level_3': 'ha'}
-    series_teams = pd.merge(left=playoff_fields.reset_index(), right=series_teams.reset_index(), on='seed')[cols].rename(columns=col_mapper)
+# Read on first use, rather than at import
+@functools.cache
+def get_playoff_format():
+    return pd.read_csv('playoff_format.csv')
 
-    # compute the win probabilities
-    index_cols = ['run_id', 'lg', 'series_id']
+def __getattr__(name):
+    if name == 'playoff_format':
+        return get_playoff_format()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-    # wrangle the teams back into a row per series, to compute the probs
-    series_matchups = series_teams.set_index(index_cols + ['Length', 'ha'])[['rating'] + likelihood_field_name].unstack(-1)
-    series_matchups = series_matchups.reset_index().set_index(index_cols)
+# The standings column for the probability of advancing past each round of playoff_format
+SHARE_NAMES = ['lds_shares', 'lcs_shares', 'pennant_shares']
 
-    # now compute the win probs for each possible series matchup
-    length = series_matchups['Length'].iloc[0]
-    series_probs = probs.p_series(length, series_matchups['rating']['h'], series_matchups['rating']['a'])
-    series_matchups[('p_win', 'h')] = series_probs
-    series_matchups[('p_win', 'a')] = 1-series_probs
+# (runs x leagues x seeds) array with the team code at each playoff seed of each league, from lg_rank
+# Leagues are numbered in sorted order of their names (np.unique), i.e., A (the AL) then N (the NL)
+def get_seeds(standings, num_teams, num_seeds):
+    lg_rank = sim_utils.standings_matrix(standings, 'lg_rank', num_teams)
+    (leagues, lg_codes) = np.unique(standings['lg'].to_numpy()[:num_teams], return_inverse=True)
 
-    # Now compute the actual likelihood of each matchup occurring, based on teams advancing this far
-    likelihoods = 1 # If it's the first round, every series is 100% likely to happen
-    if likelihood_field_name:
-        likelihoods = series_matchups[likelihood_field_name].product(axis=1)
+    (runs, tms) = np.nonzero(lg_rank <= num_seeds)
+    seeds = np.zeros((len(lg_rank), len(leagues), num_seeds), dtype=np.int64)
+    seeds[runs, lg_codes[tms], lg_rank[runs, tms]-1] = tms
+    return seeds
 
-    # And each team's chance of winning by multiplying matchup likelihood by the team's win probability
-    p_win_true = series_matchups['p_win'].multiply(likelihoods, axis=0).stack().rename('p_win')
-
-    # now merge the probs back into the teams, and sum each team's probability from their various potential matchups
-    series_teams = pd.merge(left=series_teams, right=p_win_true, left_on=index_cols+['ha'], right_index=True)
-    p_advance = series_teams.groupby(['run_id', 'team'])['p_win'].sum().rename('p_advance')
-
-    playoff_fields = pd.merge(left=playoff_fields, right=p_advance, how='left', left_index=True, right_index=True)
-    playoff_fields.fillna({'p_advance': 1}, inplace=True)
-
-    # Update the standings with the computed p_advance
-    standings[share_name] = playoff_fields['p_advance']
-    standings.fillna({share_name: 0}, inplace = True)
-    return standings
-
-# Every matchup between an NL team and an AL team is possible, so enumerate them
+# This method computes the probabilities of advancement for every round of playoffs, for every run at once
+# We've already enumerated all the possible matchups by seed (playoff_format). For each round:
+#   Compute the likelihood of each team winning each potential series, from the seeds' ratings
+#   Compute the probability of each series happening (e.g., both teams advancing to this round)
+#   Combine the last two steps to compute the likelihood of each team advancing beyond this round
+# seed_ratings is a (runs x leagues x seeds) array; returns a list with an array of that shape for each round
+def evaluate_bracket(seed_ratings, playoff_format):
+    num_seeds = seed_ratings.shape[-1]
+    reach = np.ones(seed_ratings.shape) # Every playoff team makes the first round
+    shares = []
+    for (round_num, series) in playoff_format.groupby('Round'):
+        (h, a) = (series['TmH'].to_numpy()-1, series['TmA'].to_numpy()-1)
+        lengths = series['Length'].to_numpy()
+
+        # The win probs of the home team (by seed) in each potential series
+        p_win_h = np.empty(seed_ratings.shape[:-1] + (len(series),))
+        for length in np.unique(lengths):
+            m = lengths == length
+            p_win_h[..., m] = probs.p_series(length, seed_ratings[..., h[m]], seed_ratings[..., a[m]])
+
+        # Weight by the likelihood of each matchup happening, and sum each seed's probs over its potential series
+        likelihoods = reach[..., h] * reach[..., a]
+        seeds_h = np.eye(num_seeds)[h]
+        seeds_a = np.eye(num_seeds)[a]
+        p_advance = (likelihoods * p_win_h) @ seeds_h + (likelihoods * (1-p_win_h)) @ seeds_a
+
+        # Seeds with a bye advance as often as they got to this round
+        bye = ~(seeds_h.any(axis=0) | seeds_a.any(axis=0))
+        p_advance[..., bye] = reach[..., bye]
+
+        shares.append(p_advance)
+        reach = p_advance
+    return shares
+
+# (runs x leagues x seeds) array of one column of the standings, for the team at each seed
+def get_seed_values(standings, col, seeds, num_teams):
+    values = sim_utils.standings_matrix(standings, col, num_teams)
+    return np.take_along_axis(values, seeds.reshape(len(seeds), -1), axis=1).reshape(seeds.shape)
+
+# The inverse of get_seed_values: a standings column from a per-seed array, with 0 for teams outside the playoffs
+def seed_values_to_column(seed_values, seeds, num_teams):
+    values = np.zeros((len(seeds), num_teams))
+    np.put_along_axis(values, seeds.reshape(len(seeds), -1), seed_values.reshape(len(seeds), -1), axis=1)
+    return values.ravel()
+
+# Adds the shares of each round (SHARE_NAMES) to the standings
+# Returns the list of (runs x leagues x seeds) share arrays
+def add_series_shares(standings, seeds, num_teams):
+    seed_ratings = get_seed_values(standings, 'rating', seeds, num_teams)
+    shares = evaluate_bracket(seed_ratings, get_playoff_format())
+    for (share_name, round_shares) in zip(SHARE_NAMES, shares):
+        standings[share_name] = seed_values_to_column(round_shares, seeds, num_teams)
+    return shares
+
+WS_LENGTH = 7
+
+# Every matchup between the two leagues' playoff teams is possible, so evaluate them all as (runs x seeds x seeds) arrays:
 # Compute which team gets HFA
 # Compute series win probability of each possible matchup
-# Compute the likelihood of each possible matchup
-# Combine the last two steps to compute the likelihood of each team advancing beyond this round
-def add_ws_shares(standings):
-    # Just get the run_id, team and lg of every playoff team
-    playoff_fields = standings.query('lg_rank<=6')['lg'].reset_index()
-
-    # Enumerate all the possible WS matchups
-    series_matchups = pd.merge(left=playoff_fields.query('lg=="N"'), right=playoff_fields.query('lg=="A"'), on=['run_id'], suffixes=['_N', '_A'])
-    series_matchups.index.name = 'series_id' # Use the default RangeIndex, but give it a name
-
-    # Now break into one row per team per matchup, to merge in team data (['wpct', 'pennant_shares', 'lg', 'rating'])
-    teams = pd.concat([series_matchups['team_N'].rename('team'), series_matchups['team_A'].rename('team')])
-    teams_full  = pd.merge(left=teams, right=series_matchups['run_id'], on='series_id') # merge in run_id
-    teams_full = pd.merge(left=teams_full.reset_index(), right=standings[['wpct', 'pennant_shares', 'lg', 'rating']], on=['team', 'run_id'])
-
-    # Now back to one row per potential series
-    all_ws = teams_full.set_index(['series_id', 'run_id', 'lg'])[['team', 'wpct', 'pennant_shares', 'rating']].unstack()
-
-    # Compute the HFA for each matchup
-    hfa = np.where(all_ws['wpct']['A'] > all_ws['wpct']['N'], 'A', 'N')
-
-    # Compute the likelihood of each matchup occurring 
-    likelihood = all_ws['pennant_shares'].product(axis=1)
-
-    # Compute each team's w_prob in each potential matchup
-    rating_home = pd.Series(np.where(hfa=="N", all_ws['rating']['N'], all_ws['rating']['A']))
-    rating_away = pd.Series(np.where(hfa=="A", all_ws['rating']['N'], all_ws['rating']['A']))
-    w_prob_h = probs.p_series(7, rating_home, rating_away)
-
-    all_ws[('series_win_prob', 'A')] = np.where(hfa=="A", w_prob_h, 1-w_prob_h)
-    all_ws[('series_win_prob', 'N')] = np.where(hfa=="N", w_prob_h, 1-w_prob_h)
-
-    # Multiply each matchup's likelihood by each team's w_prob in that matchup, then sum by team
-    ws_probs = all_ws['series_win_prob'].multiply(likelihood, axis=0)
-    all_ws = pd.concat([all_ws, pd.concat([ws_probs], axis=1, keys=['ws_probs'])], axis=1)
-    ws_shares = all_ws.stack(future_stack=True).groupby(['run_id', 'team'])['ws_probs'].sum()
-
-    standings['ws_shares'] = ws_shares
-    standings.fillna({'ws_shares': 0}, inplace=True)
-
+# Compute the likelihood of each possible matchup (the outer product of the two leagues' pennant shares)
+# Combine the last two steps to compute the likelihood of each team winning the WS
+# Leagues are in get_seeds order (A, then N); the NL team gets HFA when the records are the same
+def evaluate_world_series(pennant_shares, seed_ratings, seed_wpct):
+    (rating_a, rating_n) = (seed_ratings[:, 0, :, None], seed_ratings[:, 1, None, :])
+    hfa_a = seed_wpct[:, 0, :, None] > seed_wpct[:, 1, None, :]
+
+    w_prob_h = probs.p_series(WS_LENGTH, np.where(hfa_a, rating_a, rating_n), np.where(hfa_a, rating_n, rating_a))
+    w_prob_a = np.where(hfa_a, w_prob_h, 1-w_prob_h)
+
+    likelihood = pennant_shares[:, 0, :, None] * pennant_shares[:, 1, None, :]
+    ws_a = (likelihood * w_prob_a).sum(axis=2)
+    ws_n = (likelihood * (1-w_prob_a)).sum(axis=1)
+    return np.stack([ws_a, ws_n], axis=1)
+
+def add_ws_shares(standings, seeds, pennant_shares, num_teams):
+    seed_ratings = get_seed_values(standings, 'rating', seeds, num_teams)
+    seed_wpct = get_seed_values(standings, 'wpct', seeds, num_teams)
+    ws_shares = evaluate_world_series(pennant_shares, seed_ratings, seed_wpct)
+    standings['ws_shares'] = seed_values_to_column(ws_shares, seeds, num_teams)
     return standings
\ No newline at end of file
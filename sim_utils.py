@@ -11,18 +11,99 @@ def compute_standings(gms_played, groupby = []):
     standings['wpct'] = standings['W']/standings.sum(axis=1)
     return standings.sort_values('wpct', ascending=False)
 
-def compute_standings_from_results(sim_results, incoming_standings):
-    sim_standings = compute_standings(sim_results, ['iter']).reset_index().set_index('team') 
+# Wins are counted by starting from every away team winning, and letting each home win move a win
+# from the away team to the home team, as home_win @ incidence + away_wins
+def __get_incidence(schedule):
+    games = np.arange(schedule.num_games)
+    incidence = np.zeros((schedule.num_games, schedule.num_teams), dtype=np.float32)
+    incidence[games, schedule.home] += 1
+    incidence[games, schedule.away] -= 1
+    away_wins = np.bincount(schedule.away, minlength=schedule.num_teams)
+    return (incidence, away_wins)
+
+
+# Build (n_seasons x n_teams) matrices of wins and losses directly from simulated outcomes
+# sim_results is a sim_engine.SimResults; the already-played standings are added as a broadcast vector
+def compute_standings_matrices(sim_results, incoming_standings=None):
+    schedule = sim_results.schedule
+    (incidence, away_wins) = __get_incidence(schedule)
+    games_remaining = away_wins + np.bincount(schedule.home, minlength=schedule.num_teams)
+
+    # The float32 matmul accumulates the counts exactly, and is much faster than bincount over every simulated game
+    wins = (sim_results.home_win.astype(np.float32) @ incidence).astype(np.int64) + away_wins
+    losses = games_remaining - wins
+
+    if incoming_standings is not None and len(incoming_standings)>0:
+        cur = incoming_standings[['W', 'L']].reindex(schedule.teams, fill_value=0)
+        wins += cur['W'].to_numpy()
+        losses += cur['L'].to_numpy()
+    return (wins, losses)
+
 
+# (n_seasons x n_teams) matrix of the expected wins of each team (including the played standings),
+# given the ratings the seasons were simulated with
+def compute_expected_wins(sim_results, incoming_standings=None):
+    schedule = sim_results.schedule
+    (incidence, away_wins) = __get_incidence(schedule)
+    win_prob = schedule.win_probs(sim_results.ratings)
+    expected_wins = win_prob @ incidence.astype(np.float64) + away_wins
     if incoming_standings is not None and len(incoming_standings)>0:
-        incoming_standings['iter'] = 0 # so we can just add the 'iter' columns from the two tables to keep the one from the sim
-        full_standings = incoming_standings.reset_index().set_index('team') + sim_standings
-        full_standings['wpct'] = full_standings['W'] / (full_standings['W'] + full_standings['L'])
-    else:
-        full_standings = sim_standings
+        expected_wins = expected_wins + incoming_standings['W'].reindex(schedule.teams, fill_value=0).to_numpy()
+    return np.broadcast_to(expected_wins, (sim_results.num_seasons, schedule.num_teams))
+
+
+# Full-season standings for every simulated season, indexed by ['run_id', 'team']
+# Rows are in (season, team) order, matching the layout of the matrices
+def compute_standings_from_results(sim_results, incoming_standings):
+    (wins, losses) = compute_standings_matrices(sim_results, incoming_standings)
+    index = pd.MultiIndex.from_product([sim_results.run_ids, sim_results.schedule.teams], names=['run_id', 'team'])
+    standings = pd.DataFrame({'W': wins.ravel(), 'L': losses.ravel()}, index=index)
+    standings['wpct'] = standings['W'] / (standings['W'] + standings['L'])
+    return standings
+
+# The (n_seasons x n_teams) matrix of one column of standings built by compute_standings_from_results
+def standings_matrix(standings, col, num_teams):
+    return standings[col].to_numpy().reshape(-1, num_teams)
+
+
+# Head-to-head wins matrix of the games played so far: h2h[i, j] is the number of games team i won against team j
+def compute_played_h2h(gms_played, teams):
+    h2h = np.zeros((len(teams), len(teams)), dtype=np.uint8)
+    if gms_played is not None and len(gms_played) > 0:
+        pairs = teams.get_indexer(gms_played['W']) * len(teams) + teams.get_indexer(gms_played['L'])
+        h2h += np.bincount(pairs, minlength=len(teams)**2).reshape(h2h.shape).astype(np.uint8)
+    return h2h
+
+
+# Build an (n_seasons x n_teams x n_teams) head-to-head wins matrix for every simulated season
+# h2h[run, i, j] is the number of games team i won against team j, including incoming_h2h (the played games)
+# uint8 is plenty, since no pair of teams plays more than 255 games in a season
+def compute_h2h_matrices(sim_results, incoming_h2h=None):
+    schedule = sim_results.schedule
+    (n, t) = (sim_results.num_seasons, schedule.num_teams)
+
+    # Group the games by (home, away) pairing, and count the home wins of each pairing in each season
+    pairs = schedule.home.astype(np.int64) * t + schedule.away
+    order = np.argsort(pairs, kind='stable')
+    (pair_ids, first_game, games_per_pair) = np.unique(pairs[order], return_index=True, return_counts=True)
+    home_wins = np.add.reduceat(sim_results.home_win[:, order].astype(np.uint8), first_game, axis=1)
+    (home, away) = np.divmod(pair_ids, t)
+
+    h2h = np.zeros((n, t, t), dtype=np.uint8)
+    if incoming_h2h is not None:
+        h2h += incoming_h2h
+    h2h[:, home, away] += home_wins
+    h2h[:, away, home] += (games_per_pair - home_wins).astype(np.uint8)
+    return h2h
+
+
+# A run_id identifies one simulated season across all jobs: the job_id, followed by
+# the iteration within the job (which leaves room for up to a million seasons per job)
+RUNS_PER_JOB = 1_000_000
 
-    return full_standings
+def get_run_ids(job_id, iters):
+    return job_id*RUNS_PER_JOB + iters
 
 def add_run_ids(df):
-    df['run_id'] = df['job_id'].astype(int)*10000 + df['iter']
+    df['run_id'] = get_run_ids(df['job_id'].astype(int), df['iter'])
     return df
\ No newline at end of file
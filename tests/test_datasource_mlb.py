@@ -0,0 +1,160 @@
+import datetime
+import hashlib
+import http.server
+import importlib
+import json
+import threading
+import urllib.parse
+import pytest
+
+import datasource_mlb as dm
+
+get_games = getattr(dm, '__get_games_impl')
+write_input_table = getattr(dm, '__write_input_table')
+
+TODAY = datetime.date.today()
+
+
+def day(offset):
+    return str(TODAY + datetime.timedelta(days=offset))
+
+
+def game(pk, date, home='NYY', away='BOS', score=None, **fields):
+    g = {'gamePk': pk, 'gameType': 'R', 'officialDate': date,
+         'teams': {'home': {'team': {'abbreviation': home}}, 'away': {'team': {'abbreviation': away}}}}
+    if score is not None:
+        g['teams']['home']['score'] = score[0]
+        g['teams']['away']['score'] = score[1]
+        g['isTie'] = False
+    return g | fields
+
+
+# A stand-in for the stats API's schedule endpoint, on localhost: serves games (filtered by startDate/endDate and
+# gamePks, like the stats API) with ETags, answers a matching If-None-Match with a 304, and records the requests
+# as (params, headers, status)
+class StatsAPIHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        assert url.path.endswith('/schedule')
+        games = self.server.games
+        if 'startDate' in params:
+            games = [g for g in games if params['startDate'] <= g['officialDate'] <= params['endDate']]
+        if 'gamePks' in params:
+            pks = {int(pk) for pk in params['gamePks'].split(',')}
+            games = [g for g in games if g['gamePk'] in pks]
+        dates = {}
+        for g in games:
+            dates.setdefault(g['officialDate'], []).append(g)
+        body = json.dumps({'dates': [{'date': d, 'games': gs} for (d, gs) in sorted(dates.items())]}).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        status = 304 if self.headers.get('If-None-Match') == etag else 200
+        self.server.requests.append((params, dict(self.headers), status))
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        if status == 200:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status == 200:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = http.server.ThreadingHTTPServer(('localhost', 0), StatsAPIHandler)
+    server.games = []
+    server.requests = []
+    server.url = f'http://localhost:{server.server_port}/api/v1'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Fetch the games, and store them (as update_input_data does)
+def update(api, full=False):
+    (played, remain) = get_games(full, api.url)
+    write_input_table(played, 'cur')
+    write_input_table(remain, 'remain')
+    return (played, remain)
+
+
+def test_incremental_update_merges_new_results(api):
+    api.games = [game(1, day(-10), score=(3, 2)), game(2, day(0)), game(3, day(5))]
+    update(api)
+    api.games = [game(1, day(-10), score=(3, 2)), game(2, day(0), score=(1, 4)), game(3, day(5))]
+    (played, remain) = update(api)
+
+    assert 'startDate' in api.requests[-1][0]
+    assert sorted(played.index) == [1, 2]
+    assert played.loc[2, 'W'] == 'BOS'
+    assert list(remain.index) == [3]
+
+
+def test_cancelled_and_removed_games_are_dropped(api):
+    api.games = [game(1, day(0)), game(2, day(0)), game(3, day(0)), game(4, day(5))]
+    update(api)
+    # Game 2 is cancelled, and game 3 disappears from the schedule
+    api.games = [game(1, day(0)), game(2, day(0), status={'detailedState': 'Cancelled'}), game(4, day(5))]
+    (played, remain) = update(api)
+
+    assert played is None
+    assert sorted(remain.index) == [1, 4]
+
+
+def test_moved_games_are_refetched(api):
+    api.games = [game(1, day(0)), game(2, day(5))]
+    update(api)
+    # Game 1 is postponed to a day outside the days fetched: its stub stays on the original day
+    api.games = [game(1, day(0), rescheduleDate=day(20)), game(1, day(20)), game(2, day(5))]
+    (_, remain) = update(api)
+
+    assert 'gamePks' in api.requests[-1][0]
+    assert remain.loc[1, 'date'] == day(20)
+    assert sorted(remain.index) == [1, 2]
+
+
+def test_not_modified_uses_the_cached_response(api):
+    api.games = [game(1, day(-1), score=(5, 0)), game(2, day(3))]
+    update(api)
+    # Without the stored tables, the whole season is requested again (the same request as the cached one)
+    for prefix in ['cur', 'remain']:
+        write_input_table(None, prefix)
+    (played, remain) = update(api)
+
+    assert 'If-None-Match' in api.requests[-1][1]
+    assert api.requests[-1][2] == 304
+    assert list(played.index) == [1]
+    assert list(remain.index) == [2]
+
+
+def test_full_update_replaces_stored_games(api):
+    api.games = [game(1, day(0)), game(2, day(0))]
+    update(api)
+    api.games = [game(1, day(0), score=(2, 1))]
+    (played, remain) = update(api, full=True)
+
+    assert 'startDate' not in api.requests[-1][0]
+    assert list(played.index) == [1]
+    assert remain is None or len(remain) == 0
+
+
+def test_statsapi_url_comes_from_the_environment(api, monkeypatch):
+    api.games = [game(1, day(-1), score=(5, 0)), game(2, day(3))]
+    monkeypatch.setenv('MLB_STATSAPI_URL', api.url)
+    try:
+        importlib.reload(dm)
+        (played, remain) = get_games(False)
+    finally:
+        monkeypatch.delenv('MLB_STATSAPI_URL')
+        importlib.reload(dm)
+
+    assert len(api.requests) == 1
+    assert list(played.index) == [1]
+    assert list(remain.index) == [2]
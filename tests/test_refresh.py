@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+import benchmark
+import datasource as ds
+import refresh
+import season_simulator as sim
+import sim_inputs
+import sim_output
+
+RATING_VARIATION = 100
+NUM_STORED = 1000
+
+
+# A season half played, with its remaining games simulated (and stored); then one team wins its next new_games games,
+# so its rating given the new results is far from the prior one
+# Returns that team's mean wins from refresh.main(target_ess)
+def refreshed_mean_wins(tmp_path, monkeypatch, target_ess, new_games=15):
+    monkeypatch.setattr(sim_output, 'OUTPUT_BASEDIR', str(tmp_path / f'output_{target_ess}'))
+    (played, remain, ratings) = benchmark.generate_season(frac_played=0.5, seed=0)
+    inputs = sim_inputs.build_inputs(played, remain, ratings, ds.league_structure)
+    sim.run_job(inputs, NUM_STORED, 0, RATING_VARIATION, save_output=False, save_summary=False, save_state=True, seed=1)
+
+    team = remain['team1'].iloc[0]
+    new = remain[(remain['team1'] == team) | (remain['team2'] == team)].iloc[:new_games].drop(columns='date')
+    home_win = new['team1'] == team
+    new['score1'] = np.where(home_win, 5, 3)
+    new['score2'] = np.where(home_win, 2, 4)
+    new['margin'] = new['score1'] - new['score2']
+    new['W'] = np.where(home_win, new['team1'], new['team2'])
+    new['L'] = np.where(home_win, new['team2'], new['team1'])
+    (played, remain) = (pd.concat([played, new]), remain.drop(new.index))
+    monkeypatch.setattr(ds, 'get_games', lambda: (played, remain))
+    monkeypatch.setattr(sim_inputs, 'load_inputs',
+                        lambda: sim_inputs.build_inputs(played, remain, ratings, ds.league_structure))
+
+    refresh.main(target_ess, rating_variation_amt=RATING_VARIATION, save_output=False, show_summary=False, seed=2)
+    summary = sim_output.gather_summaries()
+    return summary.loc[team, 'sum'] / summary.loc[team, 'len']
+
+
+def test_refreshed_odds_dont_depend_on_target_ess(tmp_path, monkeypatch):
+    reused_only = refreshed_mean_wins(tmp_path, monkeypatch, target_ess=0)
+    mostly_fresh = refreshed_mean_wins(tmp_path, monkeypatch, target_ess=2000)
+    assert abs(reused_only - mostly_fresh) < 2
@@ -0,0 +1,12 @@
+import numpy as np
+
+import season_simulator as sim
+
+
+def test_antithetic_pairs_mirror_their_ratings():
+    ratings = np.array([1500.0, 1550.0, 1450.0])
+    season_ratings = sim.add_variation_to_ratings(ratings, 40, 5, np.random.default_rng(0), 'antithetic')
+
+    assert season_ratings.shape == (5, 3)
+    assert np.allclose(season_ratings[0:4:2] + season_ratings[1::2], 2*ratings)
+    assert not np.allclose(season_ratings[4], ratings)
@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+import benchmark
+import season_simulator as sim
+import sim_inputs
+import sim_output
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(sim_output, 'OUTPUT_BASEDIR', str(tmp_path / 'output'))
+    return tmp_path / 'output'
+
+
+def standings(job_id, num_runs):
+    run_ids = [job_id*1_000_000 + i for i in range(num_runs)]
+    return pd.DataFrame({'run_id': run_ids, 'team': 'NYY', 'W': 90}).set_index(['run_id', 'team'])
+
+
+def test_rerunning_a_job_replaces_its_output(output_dir, monkeypatch):
+    monkeypatch.setattr(sim_inputs, 'load_inputs', lambda: benchmark.generate_inputs())
+    for _ in range(2):
+        sim.main(num_seasons=50, id=3, show_summary=False, seed=1)
+
+    results = sim_output.gather_results()
+    assert results.index.is_unique
+    assert len(results.index.get_level_values('run_id').unique()) == 50
+    assert (sim_output.gather_summaries()['len'] == 50).all()
+
+
+def test_removing_a_job_keeps_the_other_jobs_in_its_parts(output_dir):
+    with sim_output.ResultStore() as store:
+        store.write(standings(1, 5), 'standings', 1)
+        store.write(standings(2, 3), 'standings', 2)
+    sim_output.remove_job_output(1)
+
+    results = sim_output.gather_results()
+    assert sorted(results.index.get_level_values('run_id')) == [2_000_000, 2_000_001, 2_000_002]
+    assert [p['jobs'] for p in sim_output.read_manifest('standings')['parts']] == [[2]]
@@ -1,21 +1,62 @@
-import pandas as pd
+import functools
+import numpy as np
 import sim_utils
 
 
-def h2h_standings(games, teams):
-    if games is not None:
-        h2h_games = games[(games['W'].isin(teams)) & (games['L'].isin(teams))]
-        return sim_utils.compute_standings(h2h_games)
+# Head-to-head and split records for every simulated season, indexed by run (position in the job) and team code
+# The matrices are only built the first time a tie needs them
+# clinched_tie_breakers maps sorted tuples of team names to their (already decided) tie order
+# rng (a np.random.Generator) orders the ties that no tie-breaker can break
+class TiebreakRecords:
+    def __init__(self, sim_results, played_h2h, league_structure, clinched_tie_breakers, rng=None, ledger=None):
+        self.sim_results = sim_results
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.ledger = ledger
+        self.played_h2h = played_h2h
+        self.clinched_tie_breakers = clinched_tie_breakers
+        self.teams = sim_results.schedule.teams
+        self.run_ids = sim_results.run_ids
 
+        div = league_structure['div'].reindex(self.teams).to_numpy()
+        lg = league_structure['lg'].reindex(self.teams).to_numpy()
+        self.same_div = div[:, None] == div[None, :]
+        self.same_lg_other_div = (lg[:, None] == lg[None, :]) & ~self.same_div
 
-def intradivisional_records(games, teams):
-    div_games = games.query('div_W==div_L')
-    standings = sim_utils.compute_standings(div_games)
-    return standings.query('team in @teams')
+    # h2h[run, i, j] is the number of games team i won against team j
+    @functools.cached_property
+    def h2h(self):
+        return sim_utils.compute_h2h_matrices(self.sim_results, self.played_h2h)
 
+    # (W, L) matrices of each team's record against the given subset of opponents
+    def split_records(self, opponents):
+        h2h = self.h2h * opponents
+        return (h2h.sum(axis=2), h2h.sum(axis=1))
 
-# interdivisional: same league but different division
-def interdivisional_records(games, teams):
-    interdiv_games = games.query('lg_W==lg_L and div_W!=div_L')
-    standings = sim_utils.compute_standings(interdiv_games)
-    return standings.query('team in @teams')
+    @functools.cached_property
+    def intradivisional(self):
+        return self.split_records(self.same_div)
+
+    # interdivisional: same league but different division
+    @functools.cached_property
+    def interdivisional(self):
+        return self.split_records(self.same_lg_other_div)
+
+    # Convert run_ids into positions in these matrices
+    def get_runs(self, run_ids):
+        return np.searchsorted(self.run_ids, run_ids)
+
+
+# Each of these returns the (W, L) arrays of the given teams (codes) in one run, for one tie-breaker
+def h2h_standings(records, run, teams):
+    h2h = records.h2h[run][np.ix_(teams, teams)]
+    return (h2h.sum(axis=1), h2h.sum(axis=0))
+
+
+def intradivisional_records(records, run, teams):
+    (w, l) = records.intradivisional
+    return (w[run, teams], l[run, teams])
+
+
+def interdivisional_records(records, run, teams):
+    (w, l) = records.interdivisional
+    return (w[run, teams], l[run, teams])
@@ -1,26 +1,54 @@
-import random
-import logging
+import numpy as np
+import pandas as pd
+import perf_utils
 import tiebreaker_impls
-import tiebreakers_clinched
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(filename='logs/tiebreaker.log', level=logging.INFO)
 
+# An audit trail of the tie-breaking decisions, buffered in memory, and written with a job's output (as 'tiebreaks')
+# Each decision is a row: the run_id, the tied teams, their resulting order, and the rule that decided it.
+# depth is 0 for the ties in the standings, and greater for the ties broken on the way (sub-groups, and the
+# two-way ties within a three-way tie)
+# Only the runs whose run_id is a multiple of sample_every are recorded
+class TiebreakLedger:
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+        self.rows = []
 
-def break_tie(teams, games):
+    def samples(self, run_id):
+        return run_id % self.sample_every == 0
+
+    def record(self, run_id, depth, names, order, rule):
+        self.rows.append((run_id, depth, list(names), list(order), rule))
+
+    def to_frame(self):
+        return pd.DataFrame(self.rows, columns=['run_id', 'depth', 'teams', 'order', 'rule']).set_index('run_id')
+
+
+def __record(records, run, depth, names, order, rule):
+    ledger = records.ledger
+    if ledger is not None and ledger.samples(records.run_ids[run]):
+        ledger.record(int(records.run_ids[run]), depth, names, records.teams[order], rule)
+
+
+# teams are team codes; records is a tiebreaker_impls.TiebreakRecords, and run is the position of the run in it
+# depth is how deep in the recursion this tie is (see TiebreakLedger)
+# Returns the list of team codes in tie-broken order
+def break_tie(teams, records, run, depth=0):
     tms = tuple(sorted(teams))
-    if tms in tiebreakers_clinched.__clinched_tie_breakers:
-        tb = tiebreakers_clinched.__clinched_tie_breakers[tms] 
-        logger.info(f'broke tie among {teams} as {tb} based on clinched h2h tie-breaker')
+    names = tuple(sorted(records.teams[list(tms)]))
+    if names in records.clinched_tie_breakers:
+        tb = list(records.teams.get_indexer(records.clinched_tie_breakers[names]))
+        __record(records, run, depth, names, tb, 'clinched_h2h')
+        perf_utils.count('ties_broken.clinched_h2h')
         return tb
 
     # For three-way ties, per MLB rules (https://www.mlb.com/news/mlb-playoff-tiebreaker-rules)
     # First see if any team wins both two-way tie-breakers
     # Then see if any team loses both two-way tie breakers
     if len(tms) == 3:
-        t01 = break_tie(tuple((tms[0], tms[1])), games)
-        t02 = break_tie(tuple((tms[0], tms[2])), games)
-        t12 = break_tie(tuple((tms[1], tms[2])), games)
+        t01 = break_tie(tuple((tms[0], tms[1])), records, run, depth+1)
+        t02 = break_tie(tuple((tms[0], tms[2])), records, run, depth+1)
+        t12 = break_tie(tuple((tms[1], tms[2])), records, run, depth+1)
 
         # First see if any team wins both two-way tie-breakers
         if t01 is not None and t02 is not None and t12 is not None:
@@ -31,7 +59,7 @@ def break_tie(teams, games):
                 tb = [tms[1]] + list(t02)
             elif t02[0] == t12[0]: # 2 has both h2hs
                 tb = [tms[2]] + list(t01)
-            
+
             # Now see if either team has lost both tie-breakers
             elif t01[1] == t02[1]: # 0 has lost both h2hs
                 tb = list(t12) + [tms[0]]
@@ -39,12 +67,13 @@ def break_tie(teams, games):
                 tb = list(t02) + [tms[1]]
             elif t02[1] == t12[1]: # 2 has lost both h2hs
                 tb = list(t01) + [tms[2]]
-            
+
             if tb is not None:
-                logger.info(f'broke tie among {teams} as {tb} based on multiple two-way tiebreakers')
+                __record(records, run, depth, names, tb, 'two_way_tiebreakers')
+                perf_utils.count('ties_broken.two_way_tiebreakers')
                 return tb
 
-    tie_breaker_funcs = [tiebreaker_impls.h2h_standings, 
+    tie_breaker_funcs = [tiebreaker_impls.h2h_standings,
                          tiebreaker_impls.intradivisional_records,
                          tiebreaker_impls.interdivisional_records
                          ]
@@ -54,31 +83,33 @@ def break_tie(teams, games):
         if len(grp) == 1:
             return list(grp)
         else:
-            return list(break_tie(set(grp), games))
-    
+            return list(break_tie(grp, records, run, depth+1))
+
+    tm_codes = np.array(tms)
     ordering = None
     for tb_func in tie_breaker_funcs:
-        tb_output = tb_func(games, teams).reset_index()
+        (w, l) = tb_func(records, run, tm_codes)
+        # A tie-breaker can only be applied if every tied team has games that count for it
+        if (w + l == 0).any():
+            continue
+        wpct = w / (w + l)
+        levels = np.unique(wpct)[::-1] # best record first
         # If we have more than one unique value, then we don't need to iterate into further tie-breakers
-        if tb_output['wpct'].nunique() > 1:
+        if len(levels) > 1:
             # If any sub-groups of teams are still tied, we break the tie recursively
-            grps = tb_output.groupby('wpct')
-            if len(grps) == len(teams):
-                ordering = tb_output['team'].values
-            else:
-                # sum() will make a list from a list of lists
-                ordering = sum(grps['team'].apply(process_group).values, [])
+            # sum() will make a list from a list of lists
+            ordering = sum([process_group(tuple(tm_codes[wpct == level])) for level in levels], [])
             break;
-    
+
     if ordering is not None:
-        logger.info(f'broke tie among {teams} as {ordering} based on {tb_func}')
+        __record(records, run, depth, names, ordering, tb_func.__name__)
+        perf_utils.count(f'ties_broken.{tb_func.__name__}')
         return ordering
 
 
     # We have to return something when the tie is not broken, so return a random ordering
-    logger.warn(f"unbroken tie {teams}")
-    ordering = list(teams)
-    random.shuffle(ordering)
+    ordering = list(records.rng.permutation(tms))
+    __record(records, run, depth, names, ordering, 'random')
+    perf_utils.count('ties_unbroken')
     return ordering
 
-
@@ -1,33 +1,56 @@
+import functools
+import json
+import os
+import numpy as np
 import datasource as ds
-import tiebreaker_impls
-
-# This checks whether a team has clinced the H2H season series vs another team
-# And if so, it returns the tie order. Returns None otherwise
-def __check_tie_breaker(teams):
-    cur, remain = ds.get_games()
-    h2h = tiebreaker_impls.h2h_standings(cur, teams)
-    if h2h is not None and len(h2h) > 0 and len(teams) == 2:
-        leader = h2h.iloc[0]
-        gap = leader['W'] - leader['L']
-        num_remaining = len(remain.query('team1 in @teams and team2 in @teams'))
-        # This checks if one team has a clinched a >.500 record in H2H games
-        # This logic is only correct in a 2-way tie
-        # In a multi-way tie, this may yield a false positive (since multiple teams can finish >.500)
-        if gap > num_remaining:
-            return h2h.index.values
-
-# This iterates over all possible two-way ties, checks if any are clinched, caching the values
-def __find_all_clinched_tie_breakers():
-    clinched_tie_breakers = {}
-    for lg in ds.league_structure['lg'].unique():
-        tms = ds.league_structure.query("lg==@lg").index
-        for tm1 in tms:
-            for tm2 in tms:
-                if tm1 < tm2:
-                    tb = __check_tie_breaker([tm1, tm2])
-                    if tb is not None:
-                        clinched_tie_breakers[(tm1, tm2)] = tb
-    return clinched_tie_breakers
+import sim_engine
+
+__CACHE_FILENAME = 'clinched_tie_breakers.json'
+
+# A team has clinched the H2H season series vs another team if its lead in their H2H games
+# is bigger than the number of games they have left against each other
+# This logic is only correct in a 2-way tie
+# In a multi-way tie, this may yield a false positive (since multiple teams can finish >.500)
+# Computed for every same-league pair at once, from the played h2h matrix and the remaining schedule
+# Returns a map of (sorted) pairs of team names to their tie order
+def find_all_clinched_tie_breakers(played_h2h, schedule, league_structure):
+    teams = schedule.teams
+    remaining = np.zeros(played_h2h.shape, dtype=np.int64)
+    np.add.at(remaining, (schedule.home, schedule.away), 1)
+    remaining += remaining.T
+
+    lead = played_h2h.astype(np.int64) - played_h2h.T
+    lg = league_structure['lg'].reindex(teams).to_numpy()
+    clinched = (lead > remaining) & (lg[:, None] == lg[None, :])
+
+    (leaders, trailers) = np.nonzero(clinched)
+    return {tuple(sorted((teams[l], teams[t]))): [teams[l], teams[t]] for (l, t) in zip(leaders, trailers)}
+
+# The clinched tie-breakers are persisted next to the input data, along with the hashes of the games (cur and remain)
+# they were computed from (see datasource.get_snapshot), so later processes only recompute them when the games change
+# (and not, e.g., when just the ratings do)
+# A cache that can't be read (e.g., a truncated file) is a miss; it's written to a temporary file first
+# (one per process, as several workers may write it at once) and then renamed, so readers never see a partial one
+def __get_games_hash(snapshot):
+    return {prefix: snapshot.source_hashes[prefix] for prefix in ['cur', 'remain']}
+
+def __read_cached(games_hash):
+    path = ds.get_input_path(__CACHE_FILENAME)
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached['games_hash'] == games_hash:
+                return {tuple(sorted(tb)): tb for tb in cached['tie_breakers']}
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return None
+
+def __write_cached(games_hash, clinched_tie_breakers):
+    path = ds.get_input_path(__CACHE_FILENAME)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'games_hash': games_hash, 'tie_breakers': list(clinched_tie_breakers.values())}, f)
+    os.replace(tmp_path, path)
 
 # Adds a given tie-breaker ordering to the set of known tie-breakers
 def __add_tie_breaker(tb, teams):
@@ -45,5 +68,15 @@ def add_known_tie_breakers(tb):
         __add_tie_breaker(tb, tms)
 
 
-__clinched_tie_breakers = __find_all_clinched_tie_breakers()
-add_known_tie_breakers(__clinched_tie_breakers)
\ No newline at end of file
+# Computed on first use (once per process), rather than at import
+@functools.cache
+def get_clinched_tie_breakers():
+    snapshot = ds.get_snapshot()
+    games_hash = __get_games_hash(snapshot)
+    clinched_tie_breakers = __read_cached(games_hash)
+    if clinched_tie_breakers is None:
+        clinched_tie_breakers = find_all_clinched_tie_breakers(snapshot.arrays['played_h2h'], sim_engine.snapshot_schedule(snapshot),
+                                                               ds.league_structure)
+        __write_cached(games_hash, clinched_tie_breakers)
+    add_known_tie_breakers(clinched_tie_breakers)
+    return clinched_tie_breakers
@@ -1,20 +1,88 @@
+# Rank the remaining games by how much they matter to each team's odds
+# Rather than re-simulating the season twice per game, simulate once, and for every remaining game
+# partition the runs on that game's simulated result: each team's odds conditional on a home win
+# are its average over the runs where the home team won, and likewise for an away win
+
+import numpy as np
 import pandas as pd
+import datasource as ds
 import season_simulator as sim
+import sim_inputs
+import sim_utils
+
+# The per-run values of each metric, as (runs x teams) matrices from a chunk of standings
+METRICS = {
+    'playoffs': lambda st, t: sim_utils.standings_matrix(st, 'lg_rank', t) <= 6,
+    'div_win': lambda st, t: sim_utils.standings_matrix(st, 'div_win', t),
+    'pennant': lambda st, t: sim_utils.standings_matrix(st, 'pennant_shares', t),
+    'title': lambda st, t: sim_utils.standings_matrix(st, 'ws_shares', t),
+}
+
+
+# Returns a dict of metric -> (games x teams x 2) array of each team's odds, conditional on the home team
+# winning (index 0) or losing (index 1) each remaining game
+# The odds under an outcome that never came up in the simulated seasons (e.g., a near-certain game) are NaN
+def compute_conditional_odds(inputs, ratings, num_seasons, chunk_size=5000, rating_variation_amt=0, rng=None):
+    schedule = inputs.schedule
+    sums_home_win = {m: np.zeros((schedule.num_games, schedule.num_teams)) for m in METRICS}
+    totals = {m: np.zeros(schedule.num_teams) for m in METRICS}
+    home_wins = np.zeros(schedule.num_games)
+
+    for (sim_results, standings) in sim.sim_in_chunks(inputs, ratings, num_seasons, chunk_size,
+                                                      rating_variation_amt=rating_variation_amt, rng=rng):
+        home_win = sim_results.home_win.astype(np.float64)
+        home_wins += home_win.sum(axis=0)
+        for (metric, get_values) in METRICS.items():
+            values = get_values(standings, schedule.num_teams).astype(np.float64)
+            sums_home_win[metric] += home_win.T @ values
+            totals[metric] += values.sum(axis=0)
+
+    away_wins = num_seasons - home_wins
+    def conditional(sums, counts):
+        return np.divide(sums, counts[:, None], out=np.full(sums.shape, np.nan), where=counts[:, None] > 0)
+    return {m: np.stack([conditional(sums_home_win[m], home_wins),
+                         conditional(totals[m] - sums_home_win[m], away_wins)], axis=-1)
+            for m in METRICS}
+
+
+# One row per remaining game, with the team's odds under each outcome, ranked by the swing between them
+# Without a team, games are ranked by the total swing across all teams
+# Games with an outcome that never came up in the simulated seasons have no swing to measure, and are left out
+def rank_games(odds, schedule, remain, team=None):
+    games = remain.loc[schedule.game_ids].copy()
+    simulated = ~np.isnan(odds).any(axis=(1, 2))
+    (games, odds) = (games[simulated], odds[simulated])
+    if team is not None:
+        (if_home_win, if_away_win) = (odds[:, schedule.teams.get_loc(team), 0], odds[:, schedule.teams.get_loc(team), 1])
+        games['if_team1_wins'] = if_home_win
+        games['if_team2_wins'] = if_away_win
+        games['swing'] = np.abs(if_home_win - if_away_win)
+        games['root_for'] = np.select([if_home_win > if_away_win, if_home_win < if_away_win], [games['team1'], games['team2']], '')
+    else:
+        games['swing'] = np.abs(odds[..., 0] - odds[..., 1]).sum(axis=1)
+    return games.sort_values('swing', ascending=False)
+
 
-def sim_one_way(incoming_standings, game_id, prob, num_iterations, remain):
-    orig_prob = remain.loc[game_id, 'rating_prob1']
-    remain.loc[game_id, 'rating_prob1'] = prob
-    sim_results = sim.sim_n_seasons(incoming_standings, remain, num_iterations)
-    remain.loc[game_id, 'rating_prob1'] = orig_prob
-    results = sim.summarize_sim_results(sim_results)
-    wp1 = results['champ_shares'].rename(f'{prob}')
-    return wp1
+def main(team: str = None, date: str = None, metric: str = 'playoffs', num_seasons: int = 10000, top: int = 20, chunk_size: int = 5000,
+         rating_variation_amt: int = 0, seed: int = None):
+    if metric not in METRICS:
+        raise typer.BadParameter(f'metric must be one of {list(METRICS)}')
+    inputs = sim_inputs.load_inputs()
+    if team is not None and team not in inputs.schedule.teams:
+        raise typer.BadParameter(f'Unknown team {team}')
 
+    odds = compute_conditional_odds(inputs, inputs.ratings, num_seasons, chunk_size, rating_variation_amt, np.random.default_rng(seed))
+    (_, remain) = ds.get_games()
+    games = rank_games(odds[metric], inputs.schedule, remain, team)
+    if date is not None:
+        if 'date' not in games:
+            raise typer.BadParameter('The remaining schedule has no game dates (re-run datasource_mlb update_input_data)')
+        games = games[games['date'] == date]
 
-def sim_both_ways(incoming_standings, game_id, num_iterations, remain):
-    results = pd.concat([sim_one_way(incoming_standings, game_id, prob, num_iterations, remain) for prob in [0, 1]], axis=1)
+    with pd.option_context('display.float_format', '{:,.3f}'.format):
+        print(games.head(top))
 
-    team1 = remain.loc[game_id, 'team1']
-    diff = (results['1'] - results['0']).rename(game_id)
-    return diff
 
+if __name__ == '__main__':
+    import typer
+    typer.run(main)